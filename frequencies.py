@@ -0,0 +1,148 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import polars as pl
+
+from stop_times import scan_trip_dates, scan_stop_times
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DATA_DIR = os.path.join(BASE_DIR, "./data/")
+OUTPUT_DIR = os.path.join(BASE_DIR, "./output/frequencies/")
+
+# Dates to consider (`None` means all the dates available in the stored timetables).
+START_DATE = None
+END_DATE = None
+
+N_WORKERS = os.cpu_count()
+
+HEADWAY_QUANTILES = (0.1, 0.5, 0.9)
+
+REQUIRED_FILES = ("trips.parquet", "timings.parquet", "sequences.parquet", "trip_dates.parquet")
+OUTPUT_FILES = ("routes.parquet", "route_hours.parquet", "stops.parquet")
+
+
+def headway_stats(col_name):
+    headway = pl.col(col_name).sort().diff().drop_nulls()
+    return [
+        pl.col(col_name).min().alias("first_departure"),
+        pl.col(col_name).max().alias("last_departure"),
+        headway.mean().alias("mean_headway"),
+        *(headway.quantile(q).alias(f"headway_p{round(q * 100)}") for q in HEADWAY_QUANTILES),
+    ]
+
+
+def compute_frequencies(slug_dir, start_date=None, end_date=None):
+    trips = (
+        scan_trip_dates(slug_dir, start_date, end_date)
+        .join(
+            pl.scan_parquet(os.path.join(slug_dir, "trips.parquet")).select(
+                "trip_id", "route_id", "opposite_direction", "start_time"
+            ),
+            on="trip_id",
+        )
+        .with_columns(hour=(pl.col("start_time") // 3600).cast(pl.UInt8))
+    )
+    routes = trips.group_by("date", "route_id", "opposite_direction").agg(
+        n_trips=pl.len(), *headway_stats("start_time")
+    )
+    route_hours = trips.group_by("date", "route_id", "opposite_direction", "hour").agg(
+        n_trips=pl.len()
+    )
+    stops = (
+        scan_stop_times(slug_dir, start_date, end_date)
+        .group_by("date", "stop_id", "route_id")
+        .agg(n_departures=pl.len(), *headway_stats("departure_time"))
+    )
+    routes, route_hours, stops = pl.collect_all(
+        (
+            routes.sort("date", "route_id", "opposite_direction"),
+            route_hours.sort("date", "route_id", "opposite_direction", "hour"),
+            stops.sort("date", "stop_id", "route_id"),
+        )
+    )
+    return routes, route_hours, stops
+
+
+def source_version(slug):
+    filename = os.path.join(DATA_DIR, slug, "last_update.txt")
+    if os.path.isfile(filename):
+        with open(filename, "r") as f:
+            last_update = f.read()
+    else:
+        last_update = ""
+    return f"{last_update}|{START_DATE}|{END_DATE}"
+
+
+def needs_update(slug):
+    slug_dir = os.path.join(DATA_DIR, slug)
+    if any(
+        map(
+            lambda f: not os.path.isfile(f) or os.stat(f).st_size == 0,
+            (os.path.join(slug_dir, f) for f in REQUIRED_FILES),
+        )
+    ):
+        return False
+    filename = os.path.join(OUTPUT_DIR, slug, "version.txt")
+    if not os.path.isfile(filename):
+        return True
+    with open(filename, "r") as f:
+        return f.read() != source_version(slug)
+
+
+def update_slug(slug):
+    output_dir = os.path.join(OUTPUT_DIR, slug)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    results = compute_frequencies(os.path.join(DATA_DIR, slug), START_DATE, END_DATE)
+    for df, name in zip(results, OUTPUT_FILES):
+        df.write_parquet(os.path.join(output_dir, name))
+    # The version is written last so that an interrupted slug is computed again on the next run.
+    with open(os.path.join(output_dir, "version.txt"), "w") as f:
+        f.write(source_version(slug))
+    return slug
+
+
+def update_all():
+    print(datetime.now())
+    slugs = list(filter(needs_update, sorted(os.listdir(DATA_DIR))))
+    n = len(slugs)
+    # Polars is multi-threaded so the worker processes must not be forked.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=context) as executor:
+        futures = {executor.submit(update_slug, slug): slug for slug in slugs}
+        for i, future in enumerate(as_completed(futures)):
+            slug = futures[future]
+            try:
+                future.result()
+                print(f"({i + 1}/{n}) {slug}")
+            except Exception as e:
+                print(f"Warning. Failed to compute frequencies for dataset {slug}")
+                print(e)
+
+
+def scan_report(name):
+    # All the slugs' results for one of the output files, with an additional `slug` column.
+    return pl.scan_parquet(
+        os.path.join(OUTPUT_DIR, "*", name), include_file_paths="filename"
+    ).with_columns(
+        slug=pl.col("filename").str.extract(r"([^/\\]+)[/\\][^/\\]+$", 1)
+    ).drop("filename")
+
+
+def write_national_report():
+    if not os.path.isdir(OUTPUT_DIR):
+        return
+    for name in OUTPUT_FILES:
+        if not any(
+            os.path.isfile(os.path.join(OUTPUT_DIR, slug, name)) for slug in os.listdir(OUTPUT_DIR)
+        ):
+            continue
+        scan_report(name).sink_parquet(os.path.join(OUTPUT_DIR, name))
+
+
+if __name__ == "__main__":
+    update_all()
+    write_national_report()
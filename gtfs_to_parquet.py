@@ -1,4 +1,5 @@
 import os
+import json
 from datetime import date, datetime, timezone
 from zipfile import ZipFile, BadZipFile
 
@@ -6,14 +7,41 @@ import requests
 import polars as pl
 import polars.selectors as cs
 
+from views import update_views
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 OUTPUT_DIR = os.path.join(BASE_DIR, "./data/")
 
-BASE_API_URL = "https://transport.data.gouv.fr/api"
+# Can be overridden with an environment variable (e.g. to use `mock_servers.py`).
+BASE_API_URL = os.environ.get("TDG_API_URL", "https://transport.data.gouv.fr/api")
 
 VERBOSE = False
 
+# GTFS files from which each table is built (including the files of the tables whose ids it
+# references) and output file of the table.
+TABLE_INPUT_FILES = {
+    "agencies": ("agency.txt",),
+    "routes": ("agency.txt", "routes.txt"),
+    "stops": ("stops.txt",),
+    "trips": ("agency.txt", "routes.txt", "stops.txt", "stop_times.txt", "trips.txt"),
+    "transfers": (
+        "agency.txt",
+        "routes.txt",
+        "stops.txt",
+        "stop_times.txt",
+        "trips.txt",
+        "transfers.txt",
+    ),
+}
+TABLE_FILENAMES = {
+    "agencies": "agencies.parquet",
+    "routes": "routes.parquet",
+    "stops": "stops.parquet",
+    "trips": "trip_map.parquet",
+    "transfers": "transfers.parquet",
+}
+
 
 def find_file(zipfile, filename):
     for file in zipfile.filelist:
@@ -21,6 +49,29 @@ def find_file(zipfile, filename):
             return zipfile.open(file.filename)
 
 
+def file_fingerprint(zipfile, filename):
+    for file in zipfile.filelist:
+        if file.filename.endswith(filename):
+            return f"{file.CRC:08x}-{file.file_size}"
+    return ""
+
+
+def table_fingerprints(zipfile):
+    return {
+        table: "|".join(file_fingerprint(zipfile, filename) for filename in filenames)
+        for table, filenames in TABLE_INPUT_FILES.items()
+    }
+
+
+def read_fingerprints(output_dir):
+    filename = os.path.join(output_dir, "fingerprints.json")
+    if os.path.isfile(filename):
+        with open(filename, "r") as f:
+            return json.load(f)
+    else:
+        return dict()
+
+
 def time_col_to_seconds(col_name):
     return (
         pl.col(col_name)
@@ -151,20 +202,7 @@ def download_zip(url: str, output_filename: str):
         file.write(response.content)
 
 
-def read_and_merge(input_zipfilename, output_dir, modified_date):
-    try:
-        input_zipfile = ZipFile(input_zipfilename)
-    except BadZipFile:
-        print("Warning. Skipping invalid zipfile")
-        return
-
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-
-    ############
-    #  agency  #
-    ############
-
+def read_agencies(input_zipfile, output_dir):
     if VERBOSE:
         print("Collecting agencies")
     zipped_agencies = find_file(input_zipfile, "agency.txt")
@@ -185,15 +223,10 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
             keep="first", maintain_order=True
         )
     agencies = agencies.with_columns(agency_id=pl.int_range(pl.len(), dtype=pl.UInt32))
-    agencies = agencies.collect()
-    agency_id_map = agencies.select("original_agency_id", "agency_id").unique(
-        subset="original_agency_id", keep="last"
-    )
+    return agencies.collect()
 
-    ############
-    #  routes  #
-    ############
 
+def read_routes(input_zipfile, output_dir, agency_id_map):
     if VERBOSE:
         print("Collecting routes")
     zipped_routes = find_file(input_zipfile, "routes.txt")
@@ -315,15 +348,10 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
             keep="first", maintain_order=True
         )
     routes = routes.with_columns(route_id=pl.int_range(pl.len(), dtype=pl.UInt32))
-    routes = routes.collect()
-    route_id_map = routes.select("original_route_id", "route_id").unique(
-        subset="original_route_id", keep="last"
-    )
+    return routes.collect()
 
-    ###########
-    #  stops  #
-    ###########
 
+def read_stops(input_zipfile, output_dir):
     if VERBOSE:
         print("Collecting stops")
     zipped_stops = find_file(input_zipfile, "stops.txt")
@@ -368,12 +396,13 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
     if os.path.isfile(filename):
         previous_stops = pl.read_parquet(filename)
         # Add new stops and stops with updated characteristics.
-        # Columns `stop_id` and `parent_station_id` are null at that point for the newly added stops.
+        # Columns `stop_id` and `parent_station_id` are null at that point for the newly added
+        # stops.
         all_stops = pl.concat((previous_stops, stops), how="diagonal", rechunk=True).unique(
             subset=cs.exclude("stop_id", "parent_station_id"), maintain_order=True, keep="first"
         )
-        # Add stops that were not updated but whose parent station was updated (we do it twice to handle
-        # parents' of parents).
+        # Add stops that were not updated but whose parent station was updated (we do it twice to
+        # handle parents' of parents).
         for _ in range(2):
             added_stops = all_stops.filter(pl.col("stop_id").is_null())["original_stop_id"]
             to_add_stops = stops.filter(
@@ -387,7 +416,7 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
     stop_id_map = all_stops.select("original_stop_id", "stop_id").unique(
         subset="original_stop_id", keep="last"
     )
-    all_stops = all_stops.with_columns(
+    return all_stops.with_columns(
         parent_station_id=pl.when(pl.col("parent_station_id").is_null())
         .then(
             pl.col("original_parent_station_id").replace_strict(
@@ -397,10 +426,8 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
         .otherwise("parent_station_id")
     )
 
-    ################
-    #  Stop times  #
-    ################
 
+def read_stop_times(input_zipfile, stop_id_map):
     if VERBOSE:
         print("Collecting stop_times")
     zipped_stop_times = find_file(input_zipfile, "stop_times.txt")
@@ -461,9 +488,10 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
         columns.append(pl.col("timepoint").cast(pl.Boolean, strict=False).alias("exact_times"))
     else:
         columns.append(pl.lit(None, dtype=pl.Boolean).alias("exact_times"))
-    stop_times = stop_times.select(columns)
-    stop_times = stop_times.collect()
+    return stop_times.select(columns).collect()
+
 
+def read_sequences(stop_times, output_dir):
     if VERBOSE:
         print("Creating stop sequences")
     sequences = (
@@ -473,16 +501,17 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
         .drop("trip_id")
         .unique(maintain_order=True)
     )
-
     filename = os.path.join(output_dir, "sequences.parquet")
     if os.path.isfile(filename):
         previous_sequences = pl.scan_parquet(filename).drop("sequence_id")
-        sequences = pl.concat((previous_sequences, sequences), how="vertical", rechunk=True).unique(
-            keep="first", maintain_order=True
-        )
+        sequences = pl.concat(
+            (previous_sequences, sequences), how="vertical", rechunk=True
+        ).unique(keep="first", maintain_order=True)
     sequences = sequences.with_columns(sequence_id=pl.int_range(pl.len(), dtype=pl.UInt32))
-    sequences = sequences.collect()
+    return sequences.collect()
+
 
+def read_timings(stop_times, sequences, output_dir):
     if VERBOSE:
         print("Creating stop timings")
     timings = (
@@ -500,7 +529,6 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
         .join(sequences.lazy(), on=["stop_id", "pickup_type", "drop_off_type"], how="left")
         .select("stopping_time", "between_stop_time", "sequence_id")
     )
-
     filename = os.path.join(output_dir, "timings.parquet")
     if os.path.isfile(filename):
         previous_timings = pl.scan_parquet(filename).drop("timing_id")
@@ -508,7 +536,15 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
             keep="first", maintain_order=True
         )
     timings = timings.with_columns(timing_id=pl.int_range(pl.len(), dtype=pl.UInt32))
-    timings = timings.collect()
+    return timings.collect()
+
+
+def read_trips(input_zipfile, output_dir, stop_id_map, route_id_map):
+    # Returns the stop sequences, the stop timings, all the trips, the map of the trip ids (with
+    # their service) and the number of trips of the previous version.
+    stop_times = read_stop_times(input_zipfile, stop_id_map)
+    sequences = read_sequences(stop_times, output_dir)
+    timings = read_timings(stop_times, sequences, output_dir)
 
     if VERBOSE:
         print("Creating trip sequence and timings")
@@ -524,15 +560,13 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
             start_time=pl.col("arrival_time").first(),
         )
         .join(sequences.lazy(), on=["stop_id", "pickup_type", "drop_off_type"], how="left")
-        .join(timings.lazy(), on=["stopping_time", "between_stop_time", "sequence_id"], how="left")
+        .join(
+            timings.lazy(), on=["stopping_time", "between_stop_time", "sequence_id"], how="left"
+        )
         .select("trip_id", "start_time", "timing_id", "sequence_id")
         .collect()
     )
 
-    ###########
-    #  Trips  #
-    ###########
-
     if VERBOSE:
         print("Collecting trips")
     zipped_trips = find_file(input_zipfile, "trips.txt")
@@ -599,102 +633,173 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
     filename = os.path.join(output_dir, "trips.parquet")
     if os.path.isfile(filename):
         previous_trips = pl.read_parquet(filename).drop("trip_id")
+        n_previous_trips = len(previous_trips)
         all_trips = pl.concat(
             (previous_trips, trips.drop("original_trip_id")), how="vertical", rechunk=True
         ).unique(keep="first", maintain_order=True)
     else:
+        n_previous_trips = 0
         all_trips = trips.drop("original_trip_id").unique(maintain_order=True)
     join_columns = all_trips.columns
     all_trips = all_trips.with_columns(trip_id=pl.int_range(pl.len(), dtype=pl.UInt32))
     trip_id_map = trips.join(all_trips, on=join_columns, how="left", join_nulls=True).select(
         "original_trip_id", "trip_id"
     )
+    trip_map = trip_id_map.join(original_trips, on="original_trip_id", how="left")
+    return sequences, timings, all_trips, trip_map, n_previous_trips
 
-    ###############
-    #  Transfers  #
-    ###############
 
+def read_transfers(zipped_transfers, output_dir, stop_id_map, route_id_map, trip_id_map):
     if VERBOSE:
         print("Collecting transfers")
-    transfers = None
-    zipped_transfers = find_file(input_zipfile, "transfers.txt")
-    if zipped_transfers is not None:
-        transfers = pl.scan_csv(
-            zipped_transfers.read(),
-            schema_overrides={
-                "from_stop_id": pl.String,
-                "to_stop_id": pl.String,
-                "from_route_id": pl.String,
-                "to_route_id": pl.String,
-                "from_trip_id": pl.String,
-                "to_trip_id": pl.String,
-                "transfer_type": pl.UInt8,
-                "min_transfer_time": pl.UInt32,
-            },
-        )
-        available_columns = transfers.collect_schema().names()
-        transfer_types = {
-            0: "recommended_transfer",
-            1: "timed_transfer",
-            2: "minimum_time",
-            3: "unfeasible_transfer",
-            4: "sequential_trips_in-seat_transfer",
-            5: "sequential_trips_alight_transfer",
-        }
-        enum = pl.Enum(transfer_types.values())
-        columns = [
-            pl.col("from_stop_id").replace_strict(
-                stop_id_map["original_stop_id"], stop_id_map["stop_id"]
-            ),
-            pl.col("to_stop_id").replace_strict(
-                stop_id_map["original_stop_id"], stop_id_map["stop_id"]
-            ),
-            pl.col("transfer_type").replace_strict(transfer_types, default=None).cast(enum),
-        ]
-        if "from_route_id" in available_columns:
-            columns.append(
-                pl.col("from_route_id").replace_strict(
-                    route_id_map["original_route_id"], route_id_map["route_id"], default=None
-                )
+    transfers = pl.scan_csv(
+        zipped_transfers.read(),
+        schema_overrides={
+            "from_stop_id": pl.String,
+            "to_stop_id": pl.String,
+            "from_route_id": pl.String,
+            "to_route_id": pl.String,
+            "from_trip_id": pl.String,
+            "to_trip_id": pl.String,
+            "transfer_type": pl.UInt8,
+            "min_transfer_time": pl.UInt32,
+        },
+    )
+    available_columns = transfers.collect_schema().names()
+    transfer_types = {
+        0: "recommended_transfer",
+        1: "timed_transfer",
+        2: "minimum_time",
+        3: "unfeasible_transfer",
+        4: "sequential_trips_in-seat_transfer",
+        5: "sequential_trips_alight_transfer",
+    }
+    enum = pl.Enum(transfer_types.values())
+    columns = [
+        pl.col("from_stop_id").replace_strict(
+            stop_id_map["original_stop_id"], stop_id_map["stop_id"]
+        ),
+        pl.col("to_stop_id").replace_strict(
+            stop_id_map["original_stop_id"], stop_id_map["stop_id"]
+        ),
+        pl.col("transfer_type").replace_strict(transfer_types, default=None).cast(enum),
+    ]
+    if "from_route_id" in available_columns:
+        columns.append(
+            pl.col("from_route_id").replace_strict(
+                route_id_map["original_route_id"], route_id_map["route_id"], default=None
             )
-        else:
-            columns.append(pl.lit(None, dtype=pl.UInt32).alias("from_route_id"))
-        if "to_route_id" in available_columns:
-            columns.append(
-                pl.col("to_route_id").replace_strict(
-                    route_id_map["original_route_id"], route_id_map["route_id"], default=None
-                )
+        )
+    else:
+        columns.append(pl.lit(None, dtype=pl.UInt32).alias("from_route_id"))
+    if "to_route_id" in available_columns:
+        columns.append(
+            pl.col("to_route_id").replace_strict(
+                route_id_map["original_route_id"], route_id_map["route_id"], default=None
             )
-        else:
-            columns.append(pl.lit(None, dtype=pl.UInt32).alias("to_route_id"))
-        if "from_trip_id" in available_columns:
-            columns.append(
-                pl.col("from_trip_id").replace_strict(
-                    trip_id_map["original_trip_id"], trip_id_map["trip_id"], default=None
-                )
+        )
+    else:
+        columns.append(pl.lit(None, dtype=pl.UInt32).alias("to_route_id"))
+    if "from_trip_id" in available_columns:
+        columns.append(
+            pl.col("from_trip_id").replace_strict(
+                trip_id_map["original_trip_id"], trip_id_map["trip_id"], default=None
             )
-        else:
-            columns.append(pl.lit(None, dtype=pl.UInt32).alias("from_trip_id"))
-        if "to_trip_id" in available_columns:
-            columns.append(
-                pl.col("to_trip_id").replace_strict(
-                    trip_id_map["original_trip_id"], trip_id_map["trip_id"], default=None
-                )
+        )
+    else:
+        columns.append(pl.lit(None, dtype=pl.UInt32).alias("from_trip_id"))
+    if "to_trip_id" in available_columns:
+        columns.append(
+            pl.col("to_trip_id").replace_strict(
+                trip_id_map["original_trip_id"], trip_id_map["trip_id"], default=None
             )
-        else:
-            columns.append(pl.lit(None, dtype=pl.UInt32).alias("to_trip_id"))
-        if "min_transfer_time" in available_columns:
-            columns.append("min_transfer_time")
-        else:
-            columns.append(pl.lit(None, dtype=pl.UInt32).alias("min_transfer_time"))
-        transfers = transfers.select(columns)
-        filename = os.path.join(output_dir, "transfers.parquet")
-        if os.path.isfile(filename):
-            previous_transfers = pl.scan_parquet(filename)
-            transfers = pl.concat(
-                (previous_transfers, transfers), how="vertical", rechunk=True
-            ).unique(keep="first", maintain_order=True)
-        transfers = transfers.collect()
+        )
+    else:
+        columns.append(pl.lit(None, dtype=pl.UInt32).alias("to_trip_id"))
+    if "min_transfer_time" in available_columns:
+        columns.append("min_transfer_time")
+    else:
+        columns.append(pl.lit(None, dtype=pl.UInt32).alias("min_transfer_time"))
+    transfers = transfers.select(columns)
+    filename = os.path.join(output_dir, "transfers.parquet")
+    if os.path.isfile(filename):
+        previous_transfers = pl.scan_parquet(filename)
+        transfers = pl.concat((previous_transfers, transfers), how="vertical", rechunk=True).unique(
+            keep="first", maintain_order=True
+        )
+    return transfers.collect()
+
+
+def read_and_merge(input_zipfilename, output_dir, modified_date):
+    try:
+        input_zipfile = ZipFile(input_zipfilename)
+    except BadZipFile:
+        print("Warning. Skipping invalid zipfile")
+        return
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    # Tables whose input files are identical to the ones of the previously ingested version are
+    # read from the output directory instead of being parsed again.
+    fingerprints = table_fingerprints(input_zipfile)
+    previous_fingerprints = read_fingerprints(output_dir)
+    unchanged_tables = {
+        table
+        for table, fingerprint in fingerprints.items()
+        if previous_fingerprints.get(table) == fingerprint
+        and os.path.isfile(os.path.join(output_dir, TABLE_FILENAMES[table]))
+    }
+
+    if "agencies" in unchanged_tables:
+        if VERBOSE:
+            print("Agencies are unchanged")
+        agencies = pl.read_parquet(os.path.join(output_dir, "agencies.parquet"))
+    else:
+        agencies = read_agencies(input_zipfile, output_dir)
+    agency_id_map = agencies.select("original_agency_id", "agency_id").unique(
+        subset="original_agency_id", keep="last"
+    )
+
+    if "routes" in unchanged_tables:
+        if VERBOSE:
+            print("Routes are unchanged")
+        routes = pl.read_parquet(os.path.join(output_dir, "routes.parquet"))
+    else:
+        routes = read_routes(input_zipfile, output_dir, agency_id_map)
+    route_id_map = routes.select("original_route_id", "route_id").unique(
+        subset="original_route_id", keep="last"
+    )
+
+    if "stops" in unchanged_tables:
+        if VERBOSE:
+            print("Stops are unchanged")
+        all_stops = pl.read_parquet(os.path.join(output_dir, "stops.parquet"))
+    else:
+        all_stops = read_stops(input_zipfile, output_dir)
+    stop_id_map = all_stops.select("original_stop_id", "stop_id").unique(
+        subset="original_stop_id", keep="last"
+    )
+
+    trip_map_filename = os.path.join(output_dir, "trip_map.parquet")
+    if "trips" in unchanged_tables:
+        # Files agency.txt, routes.txt, stops.txt, stop_times.txt and trips.txt are unchanged
+        # since the previous version so the trip ids are also unchanged.
+        if VERBOSE:
+            print("Trips are unchanged")
+        trip_map = pl.read_parquet(trip_map_filename)
+    else:
+        sequences, timings, all_trips, trip_map, n_previous_trips = read_trips(
+            input_zipfile, output_dir, stop_id_map, route_id_map
+        )
+    trip_id_map = trip_map.select("original_trip_id", "trip_id")
+    original_trips = trip_map.select("original_trip_id", "service_id")
+
+    transfers = None
+    zipped_transfers = find_file(input_zipfile, "transfers.txt")
+    if zipped_transfers is not None and "transfers" not in unchanged_tables:
+        transfers = read_transfers(
+            zipped_transfers, output_dir, stop_id_map, route_id_map, trip_id_map
+        )
 
     ##############
     #  Calendar  #
@@ -810,15 +915,31 @@ def read_and_merge(input_zipfilename, output_dir, modified_date):
 
     if VERBOSE:
         print("Saving output")
-    agencies.write_parquet(os.path.join(output_dir, "agencies.parquet"))
-    routes.write_parquet(os.path.join(output_dir, "routes.parquet"))
-    all_stops.write_parquet(os.path.join(output_dir, "stops.parquet"))
-    sequences.write_parquet(os.path.join(output_dir, "sequences.parquet"))
-    timings.write_parquet(os.path.join(output_dir, "timings.parquet"))
-    all_trips.write_parquet(os.path.join(output_dir, "trips.parquet"))
+    # The fingerprints are removed until all the files are written so that the tables are not
+    # reused if the output is only partially written.
+    fingerprints_filename = os.path.join(output_dir, "fingerprints.json")
+    if os.path.isfile(fingerprints_filename):
+        os.remove(fingerprints_filename)
+    if "agencies" not in unchanged_tables:
+        agencies.write_parquet(os.path.join(output_dir, "agencies.parquet"))
+    if "routes" not in unchanged_tables:
+        routes.write_parquet(os.path.join(output_dir, "routes.parquet"))
+    if "stops" not in unchanged_tables:
+        all_stops.write_parquet(os.path.join(output_dir, "stops.parquet"))
+    if "trips" not in unchanged_tables:
+        sequences.write_parquet(os.path.join(output_dir, "sequences.parquet"))
+        timings.write_parquet(os.path.join(output_dir, "timings.parquet"))
+        all_trips.write_parquet(os.path.join(output_dir, "trips.parquet"))
+        trip_map.write_parquet(trip_map_filename)
     if transfers is not None:
         transfers.write_parquet(os.path.join(output_dir, "transfers.parquet"))
     trip_dates.write_parquet(os.path.join(output_dir, "trip_dates.parquet"))
+    if "trips" not in unchanged_tables:
+        if VERBOSE:
+            print("Updating views")
+        update_views(output_dir, all_trips, sequences, routes, n_previous_trips)
+    with open(fingerprints_filename, "w") as f:
+        json.dump(fingerprints, f)
     if VERBOSE:
         print("Done")
 
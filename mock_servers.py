@@ -0,0 +1,415 @@
+import io
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from zipfile import ZipFile
+from datetime import datetime, timedelta, UTC
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the PRIM API (`/marketplace/...`) and the transport.data.gouv.fr API
+# (`/api/...`), serving synthetic (or recorded) responses so that the collectors can be run and
+# benchmarked offline. Run it with `python mock_servers.py` then point the collectors to it:
+#
+#   PRIM_API_URL=http://localhost:8000/marketplace TDG_API_URL=http://localhost:8000/api \
+#     PRIM_API_KEY=mock python real_time/global_request.py
+#
+# With `--replay-dir`, the files found in `REPLAY_DIR/<request path>/` are served (in turn) instead
+# of the synthetic responses, e.g. `REPLAY_DIR/marketplace/estimated-timetable/*.json`. The raw
+# estimated timetables archived by the collectors (`*.json.zst`, see `real_time/raw.py`) can be
+# used directly. The archived line reports hold the responses of all the lines of a sweep: put in
+# `REPLAY_DIR/marketplace/v2/navitia/line_reports/`, each line is served its own response.
+
+PORT = 8000
+
+LINE_REPORTS_PATH = ["marketplace", "v2", "navitia", "line_reports"]
+
+LINES = [
+    "STIF:Line::C01742:",
+    "STIF:Line::C01743:",
+    "STIF:Line::C01727:",
+    "STIF:Line::C01728:",
+    "STIF:Line::C01729:",
+]
+
+CHUNK_SIZE = 1 << 16
+
+
+def iso_time(t):
+    return t.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def estimated_call(rng, line_idx, i, t):
+    departure = t + timedelta(seconds=rng.randint(0, 60))
+    return {
+        "StopPointRef": {"value": f"STIF:StopPoint:Q:{100000 * (line_idx + 1) + i}:"},
+        "Order": i + 1,
+        "ArrivalStatus": "onTime",
+        "DepartureStatus": "onTime",
+        "AimedArrivalTime": iso_time(t),
+        "ExpectedArrivalTime": iso_time(t + timedelta(seconds=rng.randint(-30, 120))),
+        "AimedDepartureTime": iso_time(t),
+        "ExpectedDepartureTime": iso_time(departure),
+    }
+
+
+def estimated_journey(rng, config, i, now):
+    line_idx = i % len(config.lines)
+    start = now + timedelta(minutes=rng.randint(-90, 60))
+    calls = [
+        estimated_call(rng, line_idx, j, start + timedelta(minutes=2 * j))
+        for j in range(config.calls)
+    ]
+    return {
+        "LineRef": {"value": config.lines[line_idx]},
+        "DatedVehicleJourneyRef": {"value": f"RATP-SIV:VehicleJourney::MOCK{i}:LOC"},
+        "DestinationRef": {"value": calls[-1]["StopPointRef"]["value"]},
+        "DestinationName": [{"value": f"Terminus {line_idx}"}],
+        "VehicleFeatureRef": ["longTrain" if rng.random() < 0.5 else "shortTrain"],
+        "EstimatedCalls": {"EstimatedCall": calls},
+    }
+
+
+def estimated_timetable(config, now):
+    rng = random.Random(int(now.timestamp()))
+    journeys = [estimated_journey(rng, config, i, now) for i in range(config.journeys)]
+    return {
+        "Siri": {
+            "ServiceDelivery": {
+                "ResponseTimestamp": iso_time(now),
+                "EstimatedTimetableDelivery": [
+                    {
+                        "ResponseTimestamp": iso_time(now),
+                        "EstimatedJourneyVersionFrame": [
+                            {"RecordedAtTime": iso_time(now), "EstimatedVehicleJourney": journeys}
+                        ],
+                    }
+                ],
+            }
+        }
+    }
+
+
+def stop_monitoring(config, now, stop_ref, line):
+    rng = random.Random(f"{stop_ref}{int(now.timestamp())}")
+    visits = list()
+    for i in range(config.visits):
+        t = now + timedelta(minutes=rng.randint(-30, 60))
+        call = estimated_call(rng, 0, 0, t)
+        call["StopPointRef"] = {"value": stop_ref}
+        visits.append(
+            {
+                "MonitoredVehicleJourney": {
+                    "LineRef": {"value": line or config.lines[0]},
+                    "OperatorRef": {"value": "SNCF_ACCES_CLOUD:Operator::SNCF:"},
+                    "DestinationRef": {"value": "STIF:StopPoint:Q:1:"},
+                    "DestinationName": [{"value": "Terminus"}],
+                    "VehicleFeatureRef": ["longTrain" if rng.random() < 0.5 else "shortTrain"],
+                    "MonitoredCall": call,
+                }
+            }
+        )
+    return {
+        "Siri": {
+            "ServiceDelivery": {
+                "ResponseTimestamp": iso_time(now),
+                "StopMonitoringDelivery": [{"MonitoredStopVisit": visits}],
+            }
+        }
+    }
+
+
+def line_reports(config, now, line_id):
+    rng = random.Random(line_id)
+    disruptions = list()
+    for i in range(config.disruptions):
+        begin = now - timedelta(hours=rng.randint(0, 5))
+        end = now + timedelta(hours=rng.randint(1, 5))
+        disruptions.append(
+            {
+                "disruption_id": f"{line_id}-{i}",
+                "status": "active",
+                "cause": "perturbation",
+                "category": "Incidents",
+                "severity": {
+                    "name": "perturbée",
+                    "effect": "SIGNIFICANT_DELAYS",
+                    "color": "#EF662F",
+                    "priority": 30,
+                },
+                "tags": ["Actualité"],
+                "messages": [
+                    {"channel": {"name": "titre"}, "text": f"Incident {i}"},
+                    {"channel": {"name": "moteur"}, "text": f"Trafic perturbé ({i})"},
+                ],
+                "application_periods": [
+                    {
+                        "begin": begin.strftime("%Y%m%dT%H%M%S"),
+                        "end": end.strftime("%Y%m%dT%H%M%S"),
+                    }
+                ],
+                "impacted_objects": [
+                    {
+                        "pt_object": {"id": line_id},
+                        "impacted_section": {
+                            "from": {"id": "stop_area:IDFM:1", "name": "Début"},
+                            "to": {"id": "stop_area:IDFM:2", "name": "Fin"},
+                        },
+                    }
+                ],
+            }
+        )
+    return {"disruptions": disruptions}
+
+
+def dataset(config, i):
+    return {
+        "id": f"mock{i}",
+        "slug": f"mock-dataset-{i}",
+        "type": "public-transit",
+        "updated": config.updated.isoformat(),
+    }
+
+
+def dataset_details(config, dataset_id, base_url):
+    return {
+        "id": dataset_id,
+        "history": [
+            {
+                "updated_at": config.updated.isoformat(),
+                "payload": {
+                    "format": "GTFS",
+                    "permanent_url": f"{base_url}/resources/{dataset_id}.zip",
+                },
+            }
+        ],
+    }
+
+
+def gtfs_time(seconds):
+    return f"{seconds // 3600:02}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+def gtfs_zip(config, dataset_id):
+    rng = random.Random(dataset_id)
+    n_stops = max(2, config.trips // 10)
+    n_routes = max(1, config.trips // 100)
+    files = dict()
+    files["agency.txt"] = "agency_id,agency_name,agency_url,agency_timezone\n" + (
+        "1,Mock,https://example.com,Europe/Paris\n"
+    )
+    files["routes.txt"] = "route_id,agency_id,route_short_name,route_type\n" + "".join(
+        f"r{i},1,{i},3\n" for i in range(n_routes)
+    )
+    files["stops.txt"] = "stop_id,stop_name,stop_lat,stop_lon\n" + "".join(
+        f"s{i},Stop {i},{48.8 + rng.random() / 10:.6f},{2.3 + rng.random() / 10:.6f}\n"
+        for i in range(n_stops)
+    )
+    # Each route always serves the same stops.
+    route_stops = [
+        rng.sample(range(n_stops), min(n_stops, rng.randint(2, 15))) for _ in range(n_routes)
+    ]
+    trips = ["route_id,service_id,trip_id\n"]
+    stop_times = ["trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"]
+    for i in range(config.trips):
+        route = i % n_routes
+        trips.append(f"r{route},s,t{i}\n")
+        t = rng.randint(5 * 3600, 23 * 3600)
+        for j, stop in enumerate(route_stops[route]):
+            stop_times.append(f"t{i},{gtfs_time(t)},{gtfs_time(t + 30)},s{stop},{j}\n")
+            t += 30 + rng.randint(60, 300)
+    files["trips.txt"] = "".join(trips)
+    files["stop_times.txt"] = "".join(stop_times)
+    start = config.updated.date()
+    files["calendar.txt"] = (
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+        f"s,1,1,1,1,1,0,0,{start:%Y%m%d},{start + timedelta(days=30):%Y%m%d}\n"
+    )
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w") as f:
+        for filename, content in files.items():
+            f.writestr(filename, content)
+    return buffer.getvalue()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    config = None
+    # Synthetic GTFS files are generated once per dataset.
+    gtfs_cache = dict()
+    replay_counters = dict()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        config = self.config
+        url = urlsplit(self.path)
+        path = url.path.rstrip("/")
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if config.latency:
+            time.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+        if random.random() < config.rate_limit_rate:
+            return self.send_error_response(429, {"Retry-After": "1"})
+        if random.random() < config.error_rate:
+            return self.send_error_response(503)
+        parts = path.strip("/").split("/")
+        replayed = self.replay(path, parts)
+        if replayed is not None:
+            return self.send_body(*replayed)
+        now = datetime.now(UTC)
+        base_url = f"http://{self.headers.get('Host', f'localhost:{config.port}')}"
+        if path == "/marketplace/estimated-timetable":
+            body = estimated_timetable(config, now)
+        elif path == "/marketplace/stop-monitoring":
+            stop_ref = query.get("MonitoringRef", "")
+            body = stop_monitoring(config, now, stop_ref, query.get("LineRef"))
+        elif parts[:4] == LINE_REPORTS_PATH and len(parts) == 7:
+            body = line_reports(config, now, parts[5])
+        elif path == "/api/datasets":
+            body = [dataset(config, i) for i in range(config.datasets)]
+        elif parts[:2] == ["api", "datasets"] and len(parts) == 3:
+            body = dataset_details(config, parts[2], base_url)
+        elif parts[0] == "resources" and len(parts) == 2 and parts[1].endswith(".zip"):
+            dataset_id = parts[1].removesuffix(".zip")
+            with self.lock:
+                if dataset_id not in self.gtfs_cache:
+                    self.gtfs_cache[dataset_id] = gtfs_zip(config, dataset_id)
+            return self.send_body(self.gtfs_cache[dataset_id], "application/zip")
+        else:
+            return self.send_error_response(404)
+        return self.send_body(json.dumps(body).encode(), "application/json")
+
+    def replay(self, path, parts):
+        # Returns the next recorded response for this path, if any.
+        if self.config.replay_dir is None:
+            return None
+        directory = os.path.join(self.config.replay_dir, path.strip("/"))
+        replayed = self.next_replay_file(directory, directory)
+        if replayed is None:
+            if parts[:4] == LINE_REPORTS_PATH and len(parts) == 7:
+                return self.replay_line_reports(parts[5])
+            return None
+        filename, body = replayed
+        content_type = "application/zip" if filename.endswith(".zip") else "application/json"
+        return body, content_type
+
+    def replay_line_reports(self, line_id):
+        # The line reports archived by `traffic-messages.py` map the lines of a sweep (e.g.
+        # `C01742`) to their response. Each line goes through the archives in turn.
+        directory = os.path.join(self.config.replay_dir, *LINE_REPORTS_PATH)
+        replayed = self.next_replay_file(directory, (directory, line_id))
+        if replayed is None:
+            return None
+        responses = json.loads(replayed[1])
+        # The lines without response failed during the sweep, they are served without disruptions
+        # (like in `real_time/replay.py`).
+        body = responses.get(line_id.removeprefix("line:IDFM:"), {"disruptions": []})
+        return json.dumps(body).encode(), "application/json"
+
+    def next_replay_file(self, directory, counter):
+        # Returns the name and the content of the next recorded file of the directory, if any.
+        if not os.path.isdir(directory):
+            return None
+        files = sorted(
+            f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))
+        )
+        if not files:
+            return None
+        with self.lock:
+            i = self.replay_counters.get(counter, 0)
+            self.replay_counters[counter] = i + 1
+        filename = files[i % len(files)]
+        with open(os.path.join(directory, filename), "rb") as f:
+            body = f.read()
+        # The raw responses archived by the collectors are compressed with zstd.
+        if filename.endswith(".zst"):
+            import zstandard
+
+            body = zstandard.ZstdDecompressor().stream_reader(body).read()
+            filename = filename.removesuffix(".zst")
+        return filename, body
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # The body is sent by chunks, at most `bandwidth` bytes per second if set.
+        for i in range(0, len(body), CHUNK_SIZE):
+            chunk = body[i : i + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if self.config.bandwidth:
+                time.sleep(len(chunk) / self.config.bandwidth)
+
+    def send_error_response(self, code, headers=dict()):
+        self.send_response(code)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.config.verbose:
+            super().log_message(format, *args)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="mean latency of the responses (seconds)"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="standard deviation of the latency (seconds)"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.0,
+        help="bytes per second of each response (0: no limit)",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of the requests answered with 503"
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the requests answered with 429",
+    )
+    parser.add_argument("--lines", nargs="+", default=LINES, help="line refs of the SIRI journeys")
+    parser.add_argument(
+        "--journeys", type=int, default=1000, help="journeys in the estimated timetable"
+    )
+    parser.add_argument("--calls", type=int, default=20, help="calls of each journey")
+    parser.add_argument("--visits", type=int, default=20, help="visits of each monitored stop")
+    parser.add_argument("--disruptions", type=int, default=2, help="disruptions of each line")
+    parser.add_argument("--datasets", type=int, default=3, help="datasets on transport.data.gouv")
+    parser.add_argument("--trips", type=int, default=1000, help="trips of each GTFS file")
+    parser.add_argument(
+        "--replay-dir",
+        help="directory of recorded responses, served instead of the synthetic ones",
+    )
+    parser.add_argument("--verbose", action="store_true", help="log the requests")
+    config = parser.parse_args(args)
+    # The datasets are seen as updated when the server starts.
+    config.updated = datetime.now(UTC).replace(microsecond=0)
+    return config
+
+
+def run_server(config):
+    MockHandler.config = config
+    server = ThreadingHTTPServer(("127.0.0.1", config.port), MockHandler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    config = parse_args()
+    server = run_server(config)
+    print(f"Serving on http://127.0.0.1:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
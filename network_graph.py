@@ -0,0 +1,126 @@
+import os
+import sys
+
+import numpy as np
+import polars as pl
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DATA_DIR = os.path.join(BASE_DIR, "./data/")
+
+# The graph of a dataset is stored in the `graph/` sub-directory of the dataset as one `.npy` file
+# per array, so that the arrays can be memory-mapped.
+GRAPH_DIRNAME = "graph"
+
+# Stop -> stop graph in CSR (compressed sparse row) format: the edges leaving stop `i` are the edges
+# `indptr[i]` to `indptr[i + 1]` (excluded), their target stops are in `indices`.
+# Likewise, the routes of edge `j` are `route_ids[route_indptr[j]:route_indptr[j + 1]]`.
+GRAPH_ARRAYS = (
+    "indptr",
+    "indices",
+    "median_time",
+    "min_time",
+    "n_trips",
+    "route_indptr",
+    "route_ids",
+)
+
+
+def compute_edges(slug_dir):
+    trips = pl.scan_parquet(os.path.join(slug_dir, "trips.parquet")).select(
+        "route_id", "timing_id"
+    )
+    timings = pl.scan_parquet(os.path.join(slug_dir, "timings.parquet")).select(
+        "timing_id", "sequence_id", "between_stop_time"
+    )
+    sequences = pl.scan_parquet(os.path.join(slug_dir, "sequences.parquet")).select(
+        "sequence_id", "stop_id"
+    )
+    n = pl.col("stop_id").list.len() - 1
+    return (
+        trips.join(timings, on="timing_id")
+        .join(sequences, on="sequence_id")
+        .select(
+            "route_id",
+            from_stop_id=pl.col("stop_id").list.head(n),
+            to_stop_id=pl.col("stop_id").list.tail(n),
+            travel_time=pl.col("between_stop_time").list.head(n),
+        )
+        .explode("from_stop_id", "to_stop_id", "travel_time")
+        .drop_nulls("from_stop_id")
+        .group_by("from_stop_id", "to_stop_id")
+        .agg(
+            median_time=pl.col("travel_time").median().cast(pl.Float32),
+            min_time=pl.col("travel_time").min(),
+            n_trips=pl.len(),
+            route_ids=pl.col("route_id").unique().sort(),
+        )
+        .sort("from_stop_id", "to_stop_id")
+        .collect()
+    )
+
+
+def edges_to_csr(edges, n_stops):
+    counts = np.bincount(edges["from_stop_id"].to_numpy(), minlength=n_stops)
+    indptr = np.zeros(n_stops + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    route_counts = edges["route_ids"].list.len().to_numpy()
+    route_indptr = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum(route_counts, out=route_indptr[1:])
+    return {
+        "indptr": indptr,
+        "indices": edges["to_stop_id"].to_numpy().astype(np.uint32),
+        "median_time": edges["median_time"].to_numpy().astype(np.float32),
+        "min_time": edges["min_time"].fill_null(0).to_numpy().astype(np.uint32),
+        "n_trips": edges["n_trips"].to_numpy().astype(np.uint32),
+        "route_indptr": route_indptr,
+        "route_ids": edges["route_ids"].explode().drop_nulls().to_numpy().astype(np.uint32),
+    }
+
+
+def export_graph(slug_dir):
+    n_stops = (
+        pl.scan_parquet(os.path.join(slug_dir, "stops.parquet"))
+        .select(pl.col("stop_id").max() + 1)
+        .collect()
+        .item()
+    )
+    graph = edges_to_csr(compute_edges(slug_dir), n_stops)
+    graph_dir = os.path.join(slug_dir, GRAPH_DIRNAME)
+    if not os.path.isdir(graph_dir):
+        os.makedirs(graph_dir)
+    for name in GRAPH_ARRAYS:
+        np.save(os.path.join(graph_dir, f"{name}.npy"), graph[name])
+    return graph
+
+
+def load_graph(slug_dir, mmap_mode="r"):
+    graph_dir = os.path.join(slug_dir, GRAPH_DIRNAME)
+    return {
+        name: np.load(os.path.join(graph_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+        for name in GRAPH_ARRAYS
+    }
+
+
+def out_edges(graph, stop_id):
+    # Returns the indices of the edges leaving the stop and their target stops.
+    start, end = graph["indptr"][stop_id], graph["indptr"][stop_id + 1]
+    return np.arange(start, end), graph["indices"][start:end]
+
+
+def edge_routes(graph, edge):
+    return graph["route_ids"][graph["route_indptr"][edge] : graph["route_indptr"][edge + 1]]
+
+
+if __name__ == "__main__":
+    slugs = sys.argv[1:] if len(sys.argv) > 1 else sorted(os.listdir(DATA_DIR))
+    for slug in slugs:
+        slug_dir = os.path.join(DATA_DIR, slug)
+        if not os.path.isfile(os.path.join(slug_dir, "trips.parquet")):
+            continue
+        print(slug)
+        try:
+            export_graph(slug_dir)
+        except Exception as e:
+            print("Warning. Failed to export graph!")
+            print(e)
@@ -3,6 +3,8 @@ import os
 import polars as pl
 import geopandas as gpd
 
+from views import scan_stop_modes
+
 OUTPUT_DIR = "./data/"
 OUTPUT_FILENAME = "output/all_stops.parquet"
 MODES = [
@@ -45,24 +47,7 @@ for directory in os.listdir(OUTPUT_DIR):
         )
     ):
         continue
-    route_modes = pl.scan_parquet(routes).select(
-        "route_id", mode=pl.col("route_type").cast(pl.String)
-    )
-    sequence_modes = (
-        pl.scan_parquet(trips)
-        .join(route_modes, on="route_id")
-        .select("sequence_id", "mode")
-        .unique()
-    )
-    stop_modes = (
-        pl.scan_parquet(sequences)
-        .join(sequence_modes, on="sequence_id")
-        .select("mode", "stop_id")
-        .explode("stop_id")
-        .unique()
-        .group_by("stop_id")
-        .agg(modes="mode")
-    )
+    stop_modes = scan_stop_modes(os.path.join(OUTPUT_DIR, directory))
     stops = (
         pl.scan_parquet(stops)
         .join(stop_modes, on="stop_id", how="left")
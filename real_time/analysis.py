@@ -1,19 +1,13 @@
-import polars as pl
+from storage import scan_day
+from stop_refs import read_stop_table
 
-df = pl.read_parquet("./data/2025-01-21.parquet")
+df = scan_day("2025-01-21").collect()
 
-arrets = pl.scan_parquet("./arrets.parquet")
-arrets = arrets.with_columns(
-    stop_ref=pl.lit("STIF:StopPoint:Q:") + pl.col("arrid") + pl.lit(":")
-)
+stop_names = read_stop_table().select("stop_id", "zone_name")
 
-zones = pl.scan_parquet("./zones.parquet")
+assert df["stop_id"].is_in(stop_names["stop_id"]).all(), "Missing stop"
 
-stop_names = arrets.join(zones, on="zdaid", how="left").select("stop_ref", "zdaname").collect()
-
-assert df["stop_ref"].is_in(stop_names["stop_ref"]).all(), "Missing stop"
-
-df = df.join(stop_names, on="stop_ref")
+df = df.join(stop_names, on="stop_id")
 
 print("Stop frequency:")
-print(df["zdaname"].value_counts(sort=True))
+print(df["zone_name"].value_counts(sort=True))
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import polars as pl
+
+from storage import scan_day
+from stop_refs import stop_ref
+from schema import LINE_REF_TYPE, STATUS_TYPE, journey_id
+
+# Size and scan time of the stop times of a day stored with different types (see `schema.py`), and
+# check of the enum columns with the installed version of polars.
+# Usage: python bench_schema.py DAY [DAY ...]
+
+N_RUNS = 5
+LINE = "STIF:Line::C01742:"
+
+
+def read_enum_with_filter(dirname):
+    # polars 1.19 panics on this file: an enum column without nulls and with several values, read
+    # while a filter on another column is pushed down to the scan.
+    rng = np.random.default_rng(0)
+    df = pl.DataFrame(
+        {
+            "group": np.repeat(rng.integers(0, 58, 60_000), 25),
+            "status": pl.Series(["onTime", "delayed", "cancelled"])
+            .gather(rng.integers(0, 3, 60_000 * 25))
+            .cast(STATUS_TYPE),
+        }
+    )
+    filename = os.path.join(dirname, "enum.parquet")
+    df.write_parquet(filename)
+    try:
+        pl.scan_parquet(filename).filter(pl.col("group") == 31).collect()
+    except BaseException as e:
+        # `PanicException` does not derive from `Exception`.
+        print(f"polars {pl.__version__} cannot read the enum columns: {type(e).__name__}")
+        return False
+    print(f"polars {pl.__version__} reads the enum columns")
+    return True
+
+
+def variants(df):
+    enums = df.with_columns(
+        pl.col("line_ref").cast(LINE_REF_TYPE), pl.col("dep_status", "arr_status").cast(STATUS_TYPE)
+    )
+    return {
+        # Before `schema.py`.
+        "stop_ref": df.with_columns(pl.col("stop_ref").fill_null(stop_ref())).drop("stop_id"),
+        "current": df,
+        "enums": enums,
+        "enums, journey_id": enums.select(
+            journey_id() if c == "journey_ref" else c for c in enums.columns
+        ),
+    }
+
+
+def best_time(f):
+    times = list()
+    for _ in range(N_RUNS):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_day(day, dirname, can_read_enums):
+    df = scan_day(day).collect()
+    print(f"{day}: {len(df):,} stop times")
+    for name, variant in variants(df).items():
+        filename = os.path.join(dirname, f"{day}-{name.replace(', ', '-')}.parquet")
+        variant.write_parquet(filename)
+        size = os.path.getsize(filename)
+        if variant.schema["dep_status"] == STATUS_TYPE and not can_read_enums:
+            print(f"{name:>18}: {size:>12,} bytes")
+            continue
+        t = best_time(
+            lambda: pl.scan_parquet(filename).filter(pl.col("line_ref") == LINE).collect()
+        )
+        print(f"{name:>18}: {size:>12,} bytes, filter on one line in {t:.3f}s")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as dirname:
+        can_read_enums = read_enum_with_filter(dirname)
+        for day in sys.argv[1:]:
+            bench_day(day, dirname, can_read_enums)
@@ -0,0 +1,98 @@
+import sys
+import json
+import time
+from datetime import datetime
+
+import polars as pl
+
+from siri import EstimatedTimetableStream, flatten_estimated_journeys
+from global_request import lines
+from schema import normalize
+
+# Benchmark of the parsing of recorded estimated-timetable responses.
+# Usage: python bench_siri.py RESPONSE.json [RESPONSE.json ...]
+
+N_RUNS = 5
+CHUNK_SIZE = 1 << 20
+
+
+def read_stop_times_loop(timetable, now):
+    # Previous implementation, with one dict per call.
+    stop_times = list()
+    for trip in timetable:
+        try:
+            longtrain = trip["VehicleFeatureRef"][0] == "longTrain"
+        except IndexError:
+            longtrain = None
+        line_ref = trip["LineRef"]["value"]
+        journey_ref = trip["DatedVehicleJourneyRef"]["value"]
+        dest_ref = trip["DestinationRef"]["value"]
+        dest_name = trip["DestinationName"][0]["value"]
+        for call in trip["EstimatedCalls"]["EstimatedCall"]:
+            exp_dep_time = call.get("ExpectedDepartureTime")
+            if exp_dep_time and datetime.fromisoformat(exp_dep_time) > now:
+                continue
+            exp_arr_time = call.get("ExpectedArrivalTime")
+            if exp_arr_time and datetime.fromisoformat(exp_arr_time) > now:
+                continue
+            stop_times.append(
+                {
+                    "line_ref": line_ref,
+                    "journey_ref": journey_ref,
+                    "dest_ref": dest_ref,
+                    "dest_name": dest_name,
+                    "stop_ref": call["StopPointRef"]["value"],
+                    "longtrain": longtrain,
+                    "dep_status": call.get("DepartureStatus"),
+                    "arr_status": call.get("ArrivalStatus"),
+                    "exp_dep_time": exp_dep_time,
+                    "exp_arr_time": exp_arr_time,
+                    "aim_dep_time": call.get("AimedDepartureTime"),
+                    "aim_arr_time": call.get("AimedArrivalTime"),
+                }
+            )
+    return pl.DataFrame(stop_times).with_columns(
+        pl.col("exp_dep_time").str.to_datetime(),
+        pl.col("exp_arr_time").str.to_datetime(),
+        pl.col("aim_dep_time").str.to_datetime(),
+        pl.col("aim_arr_time").str.to_datetime(),
+    )
+
+
+def best_time(f):
+    times = list()
+    for _ in range(N_RUNS):
+        t0 = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+for filename in sys.argv[1:]:
+    with open(filename, "rb") as f:
+        raw = f.read()
+    print(f"=== {filename} ({len(raw) / 1e6:.1f} MB) ===")
+    data = json.loads(raw).get("Siri", dict()).get("ServiceDelivery", dict())
+    # Calls are filtered as if the request was made at the time of the response.
+    now = datetime.fromisoformat(data["ResponseTimestamp"])
+
+    def parse_full():
+        data = json.loads(raw).get("Siri", dict()).get("ServiceDelivery", dict())
+        timetable = data["EstimatedTimetableDelivery"][0]["EstimatedJourneyVersionFrame"][0][
+            "EstimatedVehicleJourney"
+        ]
+        return list(filter(lambda t: t.get("LineRef", dict()).get("value") in lines, timetable))
+
+    def parse_stream():
+        chunks = (raw[i : i + CHUNK_SIZE] for i in range(0, len(raw), CHUNK_SIZE))
+        return list(EstimatedTimetableStream(chunks, lines))
+
+    t, journeys = best_time(parse_full)
+    print(f"json.loads + filter: {t:.3f}s ({len(journeys):,} journeys)")
+    t, _ = best_time(parse_stream)
+    print(f"Streaming parser: {t:.3f}s")
+    t, df_loop = best_time(lambda: read_stop_times_loop(journeys, now))
+    print(f"Flattening (loop): {t:.3f}s ({len(df_loop):,} stop times)")
+    t, df = best_time(lambda: flatten_estimated_journeys(journeys, now))
+    print(f"Flattening (columnar): {t:.3f}s ({len(df):,} stop times)")
+    assert normalize(df_loop).equals(df), "The two flattening methods give different results"
@@ -0,0 +1,158 @@
+import os
+import argparse
+
+import polars as pl
+
+from storage import DATA_DIR, daily_filename, list_days, list_shards, scan_day
+from storage import write_parquet_atomic
+from stop_refs import read_stop_table
+
+# Delay distributions (expected minus aimed times) per line, stop, hour and kind (arrival or
+# departure) over many days.
+# The delays of each day are summarized as histograms with fixed bins, stored in
+# `data/delays/YYYY-MM-DD.parquet`. Histograms are merged by summing their counts, so extending the
+# window by one day only reads the stop times of that day, and the quantiles of any group are
+# computed from the merged histograms.
+DELAYS_DIR = os.path.join(DATA_DIR, "delays")
+
+TIMEZONE = "Europe/Paris"
+
+# Width of the bins (in seconds). The delays outside of [MIN_DELAY, MAX_DELAY] are counted in the
+# first or last bin.
+BIN_WIDTH = 30
+MIN_DELAY = -30 * 60
+MAX_DELAY = 3 * 60 * 60
+
+GROUP_KEY = ["line_ref", "stop_id", "hour", "kind"]
+QUANTILES = [0.5, 0.9, 0.99]
+
+histogram_schema = {
+    "line_ref": pl.String,
+    "stop_id": pl.UInt32,
+    "hour": pl.Int8,
+    "kind": pl.String,
+    "bin": pl.Int32,
+    "count": pl.UInt32,
+}
+
+
+def histograms_filename(day, delays_dir=DELAYS_DIR):
+    return os.path.join(delays_dir, f"{day}.parquet")
+
+
+def scan_delays(df):
+    # One row per stop time and kind, with the delay in seconds and the hour of the aimed time.
+    # The stops which are not quays have a null `stop_id` (see `schema.py`), their delays are kept.
+    return pl.concat(
+        [
+            df.select(
+                "line_ref",
+                "stop_id",
+                hour=pl.col(f"aim_{kind}_time").dt.convert_time_zone(TIMEZONE).dt.hour(),
+                kind=pl.lit(kind),
+                delay=(pl.col(f"exp_{kind}_time") - pl.col(f"aim_{kind}_time")).dt.total_seconds(),
+            )
+            for kind in ("arr", "dep")
+        ],
+        how="vertical",
+    ).drop_nulls(["delay", "hour"])
+
+
+def compute_histograms(day, data_dir=DATA_DIR):
+    bins = pl.col("delay").clip(MIN_DELAY, MAX_DELAY) // BIN_WIDTH
+    return (
+        scan_delays(scan_day(day, data_dir))
+        .group_by(*GROUP_KEY, bin=bins)
+        .agg(count=pl.len())
+        .sort(*GROUP_KEY, "bin")
+        .cast(histogram_schema)
+        .collect()
+    )
+
+
+def is_up_to_date(day, data_dir=DATA_DIR, delays_dir=DELAYS_DIR):
+    # The histograms of a day are computed again if the daily file was written after them (e.g. by
+    # `replay.py`).
+    filename = histograms_filename(day, delays_dir)
+    return os.path.isfile(filename) and os.path.getmtime(filename) >= os.path.getmtime(
+        daily_filename(day, data_dir)
+    )
+
+
+def day_histograms(day, data_dir=DATA_DIR, delays_dir=DELAYS_DIR, force=False):
+    # The histograms of the days that are not compacted yet are not stored since they are
+    # incomplete.
+    if list_shards(day, data_dir) or not os.path.isfile(daily_filename(day, data_dir)):
+        return compute_histograms(day, data_dir).lazy()
+    filename = histograms_filename(day, delays_dir)
+    if force or not is_up_to_date(day, data_dir, delays_dir):
+        if not os.path.isdir(delays_dir):
+            os.makedirs(delays_dir)
+        df = compute_histograms(day, data_dir)
+        write_parquet_atomic(df, filename)
+        print(f"{day}: {df['count'].sum():,} delays")
+    return pl.scan_parquet(filename)
+
+
+def scan_histograms(days, data_dir=DATA_DIR, delays_dir=DELAYS_DIR, force=False):
+    frames = [day_histograms(day, data_dir, delays_dir, force) for day in days]
+    if not frames:
+        return pl.LazyFrame(schema=histogram_schema)
+    return pl.concat(frames, how="vertical")
+
+
+def merge_histograms(histograms, by):
+    return (
+        histograms.group_by(*by, "bin")
+        .agg(pl.col("count").sum().cast(pl.UInt64))
+        .sort(*by, "bin")
+    )
+
+
+def histogram_quantiles(histograms, by, quantiles=QUANTILES):
+    # The distributions of arrival and departure delays are always separated.
+    by = ["kind"] + [c for c in by if c != "kind"]
+    # The value of a quantile is the upper bound of the bin where it falls.
+    upper_bound = (pl.col("bin") + 1) * BIN_WIDTH
+    return (
+        merge_histograms(histograms, by)
+        .with_columns(
+            cum_count=pl.col("count").cum_sum().over(by),
+            total=pl.col("count").sum().over(by),
+        )
+        .group_by(by)
+        .agg(
+            n=pl.col("count").sum(),
+            mean=((pl.col("bin") + 0.5) * BIN_WIDTH * pl.col("count")).sum()
+            / pl.col("count").sum(),
+            **{
+                f"q{q * 100:g}": upper_bound.filter(pl.col("cum_count") >= q * pl.col("total"))
+                .first()
+                for q in quantiles
+            },
+        )
+        .sort(by)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("start", help="first day (YYYY-MM-DD)")
+    parser.add_argument("end", help="last day (YYYY-MM-DD)")
+    parser.add_argument(
+        "--by", nargs="*", default=["line_ref"], choices=["line_ref", "stop_id", "hour"]
+    )
+    parser.add_argument("--lines", nargs="+", help="only keep these lines")
+    parser.add_argument("--quantiles", nargs="+", type=float, default=QUANTILES)
+    parser.add_argument("--force", action="store_true", help="compute all the histograms again")
+    args = parser.parse_args()
+    days = [day for day in list_days() if args.start <= day <= args.end]
+    histograms = scan_histograms(days, force=args.force)
+    if args.lines:
+        histograms = histograms.filter(pl.col("line_ref").is_in(args.lines))
+    quantiles = histogram_quantiles(histograms, args.by, args.quantiles)
+    if "stop_id" in args.by:
+        stop_names = read_stop_table().lazy().select("stop_id", "stop_name")
+        quantiles = quantiles.join(stop_names, on="stop_id", how="left")
+    with pl.Config(tbl_rows=-1):
+        print(quantiles.collect())
@@ -0,0 +1,262 @@
+import os
+import re
+import argparse
+
+import polars as pl
+
+from storage import DATA_DIR, list_days, scan_day, write_parquet_atomic
+from stop_refs import read_stop_table
+from topology import cached_topology, read_cached_topology, shortest_path
+from plot import EXTRA_EDGES, ORIGINS, load_day
+
+# Delays of the passages (recorded stop times) during the disruptions of `traffic-messages.py`.
+# A passage is attributed to a disruption if it is on the line of the disruption, at a stop of one
+# of its sections (or of the whole line if it has none) and between its start and end. The sections
+# are converted to the stops of the diagrams of the line (shortest path between the two ends in the
+# topology of the line).
+# The starts and ends of the disruptions at each stop split the time into elementary intervals, in
+# which the set of active disruptions is constant. Each passage falls into at most one of them,
+# found with an as-of join, so the passages are only joined with the disruptions which are active
+# at their time instead of with all the disruptions of their stop.
+# The impact of a disruption is compared with the baseline delay of the passages at the same line,
+# stop and hour which are not attributed to any disruption.
+
+TIMEZONE = "Europe/Paris"
+
+# Delays (in seconds) above which a passage is counted as late.
+LATE_DELAY = 5 * 60
+
+KEY = ["line_ref", "stop"]
+BASELINE_KEY = KEY + ["hour"]
+
+section_schema = {
+    "disruption": pl.UInt32,
+    "line_ref": pl.String,
+    "stop": pl.String,
+    "start": pl.Datetime("us", "UTC"),
+    "end": pl.Datetime("us", "UTC"),
+}
+
+
+def traffic_filename(day, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f"traffic-{day}.parquet")
+
+
+def read_disruptions(days, data_dir=DATA_DIR):
+    # The disruptions are recorded at each poll with the start of their current application period
+    # and the time of the poll as end (in UTC, without time zone).
+    filenames = [traffic_filename(day, data_dir) for day in days]
+    filenames = [f for f in filenames if os.path.isfile(f)]
+    if not filenames:
+        raise FileNotFoundError("No disruptions for these days")
+    return (
+        pl.scan_parquet(filenames)
+        .drop_nulls("start")
+        .group_by("id", "line", "start")
+        .agg(
+            pl.col("end").max(),
+            pl.col("title", "cause", "from_to").last(),
+            effect=pl.col("severity").struct.field("effect").last(),
+        )
+        .select(
+            "id",
+            line_ref=pl.format("STIF:Line::{}:", "line"),
+            start=pl.col("start").dt.replace_time_zone("UTC"),
+            end=pl.col("end").dt.replace_time_zone("UTC"),
+            title="title",
+            cause="cause",
+            effect="effect",
+            from_to="from_to",
+        )
+        .sort("line_ref", "start", "id")
+        .collect()
+        .with_row_index("disruption")
+    )
+
+
+def line_topology(line, day):
+    # The cached topology is used whatever its day, since the disruptions can span several weeks.
+    cache = read_cached_topology(line)
+    if cache is not None:
+        return cache["topology"]
+    try:
+        return cached_topology(
+            line, day, load_day(day, [line]), "stop", EXTRA_EDGES.get(line, ()), ORIGINS.get(line)
+        )
+    except Exception as e:
+        print(f"Warning. No topology for line {line}: {e}")
+        return None
+
+
+def resolve_stop(stop, nodes, zone_names):
+    # The Navitia stop areas (`stop_area:IDFM:<zone id>`) are matched with the stops of their zone,
+    # or else by name.
+    match = re.search(r"(\d+)$", stop["id"])
+    candidates = zone_names.get(int(match.group(1)), set()) if match else set()
+    candidates = (candidates | {stop["name"].lower()}) & nodes
+    return min(candidates) if candidates else None
+
+
+def section_stops(disruptions, topologies, zone_names):
+    # One row per disruption and impacted stop.
+    rows = list()
+    for d in disruptions.iter_rows(named=True):
+        topology = topologies.get(d["line_ref"])
+        if topology is None:
+            continue
+        nodes = set(topology["fwd_path"])
+        stops = set() if d["from_to"] else nodes
+        for section in d["from_to"]:
+            source = resolve_stop(section["from"], nodes, zone_names)
+            target = resolve_stop(section["to"], nodes, zone_names)
+            if source is None or target is None:
+                print(
+                    f"Warning. Unknown section {section['from']['name']} - "
+                    f"{section['to']['name']} of disruption {d['id']}"
+                )
+                continue
+            stops.update(shortest_path(topology, source, target))
+        rows.extend(
+            {
+                "disruption": d["disruption"],
+                "line_ref": d["line_ref"],
+                "stop": stop,
+                "start": d["start"],
+                "end": d["end"],
+            }
+            for stop in sorted(stops)
+        )
+    return pl.DataFrame(rows, schema=section_schema)
+
+
+def elementary_intervals(sections):
+    # Returns the intervals [start, end) of each stop during which at least one disruption is
+    # active, and the disruptions active in each interval.
+    bounds = pl.concat(
+        (sections.select(*KEY, time="start"), sections.select(*KEY, time="end")), how="vertical"
+    )
+    intervals = (
+        bounds.unique()
+        .sort(*KEY, "time")
+        .select(*KEY, start="time", end=pl.col("time").shift(-1).over(KEY))
+        .drop_nulls("end")
+        .with_row_index("interval")
+    )
+    active = (
+        intervals.join(sections.rename({"start": "d_start", "end": "d_end"}), on=KEY)
+        .filter(pl.col("d_start") <= pl.col("start"), pl.col("end") <= pl.col("d_end"))
+        .select("interval", "disruption")
+    )
+    return intervals.filter(pl.col("interval").is_in(active["interval"])), active
+
+
+def scan_passages(day, lines, stop_names, data_dir=DATA_DIR):
+    time = pl.col("exp_dep_time").fill_null(pl.col("exp_arr_time"))
+    delay = (pl.col("exp_dep_time") - pl.col("aim_dep_time")).fill_null(
+        pl.col("exp_arr_time") - pl.col("aim_arr_time")
+    )
+    return (
+        scan_day(day, data_dir)
+        .filter(pl.col("line_ref").is_in(lines))
+        .join(stop_names, on="stop_id")
+        .select("line_ref", "stop", time=time, delay=delay.dt.total_seconds())
+        .drop_nulls()
+        .with_columns(hour=pl.col("time").dt.convert_time_zone(TIMEZONE).dt.hour())
+        .with_row_index("passage")
+    )
+
+
+def attribute_passages(passages, intervals, active):
+    # One row per passage and active disruption.
+    return (
+        passages.sort("time")
+        .join_asof(
+            intervals.sort("start"), left_on="time", right_on="start", by=KEY, strategy="backward"
+        )
+        .filter(pl.col("time") < pl.col("end"))
+        .join(active, on="interval")
+        .drop("interval", "start", "end")
+    )
+
+
+def day_impacts(day, lines, stop_names, intervals, active, data_dir=DATA_DIR):
+    # Sums of the delays of the day, per disruption for the attributed passages and for the
+    # baseline otherwise. They are summed over all the days.
+    passages = scan_passages(day, lines, stop_names, data_dir).collect()
+    attributed = attribute_passages(passages, intervals, active)
+    impacts = attributed.group_by("disruption", *BASELINE_KEY).agg(
+        n=pl.len(), delay=pl.col("delay").sum(), n_late=(pl.col("delay") > LATE_DELAY).sum()
+    )
+    baseline = (
+        passages.filter(~pl.col("passage").is_in(attributed["passage"]))
+        .group_by(BASELINE_KEY)
+        .agg(n=pl.len(), delay=pl.col("delay").sum())
+    )
+    print(f"{day}: {attributed['passage'].n_unique():,}/{len(passages):,} disrupted passages")
+    return impacts, baseline
+
+
+def impact_report(days, lines=None, data_dir=DATA_DIR):
+    disruptions = read_disruptions(days, data_dir)
+    if lines is not None:
+        disruptions = disruptions.filter(pl.col("line_ref").is_in(lines))
+    lines = sorted(disruptions["line_ref"].unique())
+    topologies = {line: line_topology(line, days[-1]) for line in lines}
+    stop_table = read_stop_table()
+    zone_names = {
+        zone: set(names)
+        for zone, names in stop_table.drop_nulls("zone_id")
+        .group_by("zone_id")
+        .agg(pl.col("stop_name").str.to_lowercase())
+        .iter_rows()
+    }
+    stop_names = stop_table.lazy().select("stop_id", stop=pl.col("stop_name").str.to_lowercase())
+    intervals, active = elementary_intervals(section_stops(disruptions, topologies, zone_names))
+    impacts, baselines = zip(
+        *(day_impacts(day, lines, stop_names, intervals, active, data_dir) for day in days)
+    )
+    baseline = (
+        pl.concat(baselines, how="vertical")
+        .group_by(BASELINE_KEY)
+        .agg(baseline=pl.col("delay").sum() / pl.col("n").sum())
+    )
+    # The excess delay is only measured on the passages whose line, stop and hour have a baseline.
+    has_baseline = pl.col("baseline").is_not_null()
+    excess = (pl.col("delay") - pl.col("n") * pl.col("baseline")).filter(has_baseline)
+    report = (
+        pl.concat(impacts, how="vertical")
+        .group_by("disruption", *BASELINE_KEY)
+        .agg(pl.col("n", "delay", "n_late").sum())
+        .join(baseline, on=BASELINE_KEY, how="left")
+        .group_by("disruption")
+        .agg(
+            n_passages=pl.col("n").sum(),
+            n_stops=pl.col("stop").n_unique(),
+            mean_delay=pl.col("delay").sum() / pl.col("n").sum(),
+            late_share=pl.col("n_late").sum() / pl.col("n").sum(),
+            excess_delay=excess.sum() / pl.col("n").filter(has_baseline).sum(),
+        )
+        .with_columns(pl.col("excess_delay").fill_nan(None))
+    )
+    return (
+        disruptions.drop("from_to")
+        .join(report, on="disruption", how="left")
+        .with_columns(pl.col("n_passages", "n_stops").fill_null(0))
+        .drop("disruption")
+        .sort("excess_delay", descending=True, nulls_last=True)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("start", help="first day (YYYY-MM-DD)")
+    parser.add_argument("end", help="last day (YYYY-MM-DD)")
+    parser.add_argument("--lines", nargs="+", help="only keep these lines")
+    parser.add_argument("--output", help="also write the report to this parquet file")
+    args = parser.parse_args()
+    days = [day for day in list_days() if args.start <= day <= args.end]
+    report = impact_report(days, args.lines)
+    if args.output:
+        write_parquet_atomic(report, args.output)
+    with pl.Config(tbl_rows=-1, fmt_str_lengths=60):
+        print(report.drop("cause"))
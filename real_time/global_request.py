@@ -1,158 +1,168 @@
-import os
+import time
+import argparse
+import threading
 from datetime import datetime, UTC
-import json
 
 import pytz
 import requests
 import polars as pl
 
-API_URL = "https://prim.iledefrance-mobilites.fr/marketplace"
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-
-secrets_file = os.path.join(BASE_DIR, "..", "secrets.json")
-if os.path.isfile(secrets_file):
-    with open(secrets_file, "r") as f:
-        secrets = json.load(f)
-        API_KEY = secrets["api_key"]
-else:
-    raise Exception(f"Cannot read API Key from `{secrets_file}`")
-
-OUTPUT_DIR = os.path.join(BASE_DIR, "data")
-if not os.path.isdir(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
-
-lines = {
-    "STIF:Line::C01372:",
-    "STIF:Line::C01374:",
-    "STIF:Line::C01378:",
-    "STIF:Line::C01381:",
-    "STIF:Line::C01383:",
-    "STIF:Line::C01391:",
-    "STIF:Line::C01738:",
-    "STIF:Line::C01744:",
-    "STIF:Line::C01747:",
-    "STIF:Line::C02375:",
-    "STIF:Line::C01371:",
-    "STIF:Line::C01382:",
-    "STIF:Line::C01386:",
-    "STIF:Line::C01679:",
-    "STIF:Line::C01746:",
-    "STIF:Line::C01795:",
-    "STIF:Line::C01843:",
-    "STIF:Line::C01857:",
-    "STIF:Line::C02368:",
-    "STIF:Line::C02370:",
-    "STIF:Line::C02711:",
-    "STIF:Line::C00563:",
-    "STIF:Line::C01375:",
-    "STIF:Line::C01390:",
-    "STIF:Line::C01728:",
-    "STIF:Line::C01729:",
-    "STIF:Line::C01731:",
-    "STIF:Line::C01736:",
-    "STIF:Line::C01737:",
-    "STIF:Line::C01740:",
-    "STIF:Line::C01741:",
-    "STIF:Line::C01742:",
-    "STIF:Line::C01743:",
-    "STIF:Line::C01745:",
-    "STIF:Line::C01774:",
-    "STIF:Line::C01794:",
-    "STIF:Line::C01999:",
-    "STIF:Line::C01376:",
-    "STIF:Line::C01380:",
-    "STIF:Line::C01387:",
-    "STIF:Line::C01388:",
-    "STIF:Line::C01389:",
-    "STIF:Line::C01684:",
-    "STIF:Line::C01739:",
-    "STIF:Line::C02317:",
-    "STIF:Line::C02528:",
-    "STIF:Line::C02732:",
-    "STIF:Line::C01373:",
-    "STIF:Line::C01377:",
-    "STIF:Line::C01379:",
-    "STIF:Line::C01384:",
-    "STIF:Line::C01727:",
-    "STIF:Line::C01730:",
-    "STIF:Line::C01748:",
-    "STIF:Line::C01863:",
-    "STIF:Line::C02344:",
-    "STIF:Line::C02372:",
-    "STIF:Line::C02529:",
-}
+from prim import API_URL, new_session
+from scheduler import HIGH
+from schema import LINE_REFS
+from siri import iter_response_journeys, flatten_estimated_journeys, is_passed
+from storage import day_string, write_shard, compact_previous_days
+from raw import ESTIMATED_TIMETABLE, RawCapture
+from predictions import PREDICTIONS_DIR, SHARD_KEY, normalize_predictions, record_predictions
+from predictions import record_predictions_once
+
+# Default interval between two requests and between two writes of the new stop times in daemon
+# mode (in seconds).
+INTERVAL = 30
+FLUSH_INTERVAL = 300
+TIMEOUT = 60
+
+lines = set(LINE_REFS)
 
 tz = pytz.timezone("Europe/Paris")
 
-now = datetime.now(UTC)
-print("Running request")
-response = requests.get(f"{API_URL}/estimated-timetable", headers={"apiKey": API_KEY})
-
-stop_times = list()
-
-if response.ok:
-    print("Reading response")
-    data = response.json().get("Siri", dict()).get("ServiceDelivery", dict())
-    response_datetime = datetime.fromisoformat(data["ResponseTimestamp"])
-    timetable = data["EstimatedTimetableDelivery"][0]["EstimatedJourneyVersionFrame"][0][
-        "EstimatedVehicleJourney"
-    ]
-    timetable = list(filter(lambda t: t.get("LineRef", dict()).get("value") in lines, timetable))
-    for trip in timetable:
-        try:
-            longtrain = trip["VehicleFeatureRef"][0] == "longTrain"
-        except IndexError:
-            longtrain = None
-        line_ref = trip["LineRef"]["value"]
-        journey_ref = trip["DatedVehicleJourneyRef"]["value"]
-        dest_ref = trip["DestinationRef"]["value"]
-        dest_name = trip["DestinationName"][0]["value"]
-        for call in trip["EstimatedCalls"]["EstimatedCall"]:
-            exp_dep_time = call.get("ExpectedDepartureTime")
-            if exp_dep_time and datetime.fromisoformat(exp_dep_time) > now:
-                continue
-            exp_arr_time = call.get("ExpectedArrivalTime")
-            if exp_arr_time and datetime.fromisoformat(exp_arr_time) > now:
-                continue
-            aim_dep_time = call.get("AimedDepartureTime")
-            aim_arr_time = call.get("AimedArrivalTime")
-            stop_ref = call["StopPointRef"]["value"]
-            dep_status = call.get("DepartureStatus")
-            arr_status = call.get("ArrivalStatus")
-            stop_times.append(
-                {
-                    "line_ref": line_ref,
-                    "journey_ref": journey_ref,
-                    "dest_ref": dest_ref,
-                    "dest_name": dest_name,
-                    "stop_ref": stop_ref,
-                    "longtrain": longtrain,
-                    "dep_status": dep_status,
-                    "arr_status": arr_status,
-                    "exp_dep_time": exp_dep_time,
-                    "exp_arr_time": exp_arr_time,
-                    "aim_dep_time": aim_dep_time,
-                    "aim_arr_time": aim_arr_time,
-                }
-            )
-
-df = pl.DataFrame(stop_times).with_columns(
-    pl.col("exp_dep_time").str.to_datetime(),
-    pl.col("exp_arr_time").str.to_datetime(),
-    pl.col("aim_dep_time").str.to_datetime(),
-    pl.col("aim_arr_time").str.to_datetime(),
-)
-
-output_filename = os.path.join(OUTPUT_DIR, f"{now.year}-{now.month:02}-{now.day:02}.parquet")
-
-if os.path.isfile(output_filename):
-    old_df = pl.scan_parquet(output_filename)
-
-    df = (
-        pl.concat((df.lazy(), old_df), how="vertical", rechunk=True)
-        .unique(subset=["journey_ref", "stop_ref"], keep="first", maintain_order=True)
-        .collect()
-    )
 
-print(len(df))
-df.write_parquet(output_filename)
+def request_timetable(session):
+    # The response is streamed so that it can be parsed while it is received.
+    return session.get(f"{API_URL}/estimated-timetable", timeout=TIMEOUT, stream=True)
+
+
+def poll(session, now, capture=False):
+    # Returns all the calls of the tracked lines, including the future ones.
+    # If `capture` is true, the raw response is archived (see `raw.py`).
+    print("Running request")
+    response = request_timetable(session)
+    if response.ok:
+        print("Reading response")
+        if capture:
+            with RawCapture(ESTIMATED_TIMETABLE, now) as raw:
+                return flatten_estimated_journeys(iter_response_journeys(response, lines, raw))
+        return flatten_estimated_journeys(iter_response_journeys(response, lines))
+    else:
+        print("Error retrieving estimated timetable with API")
+        print(f"Code: {response.status_code}")
+        print(f"Reason: {response.reason}")
+        return None
+
+
+def changed_rows(df, previous_df):
+    # Rows of the poll that were not identical in the previous poll.
+    if previous_df is None:
+        return df
+    return df.join(previous_df, on=df.columns, how="anti", join_nulls=True)
+
+
+def start_compaction(now):
+    # Shards of the previous days are merged into their daily file in the background.
+    def compact():
+        compact_previous_days(day_string(now))
+        compact_previous_days(day_string(now), PREDICTIONS_DIR, SHARD_KEY, normalize_predictions)
+
+    thread = threading.Thread(target=compact)
+    thread.start()
+    return thread
+
+
+def run_once(predictions=False, capture=False):
+    session = new_session(priority=HIGH)
+    now = datetime.now(UTC)
+    start_compaction(now)
+    calls = poll(session, now, capture)
+    if calls is None:
+        return
+    if predictions:
+        record_predictions_once(calls, now)
+    df = calls.filter(is_passed(now))
+    print(len(df))
+    write_shard(df, now)
+
+
+def run_daemon(interval, flush_interval, predictions=False, capture=False):
+    # Only the rows that changed since the previous poll are kept (the other rows are already in a
+    # shard) and they are written to a new shard every `flush_interval` seconds, from the newest
+    # poll so that the most recent rows come first (see `storage.scan_day`).
+    # The changed predictions are written at each poll.
+    session = new_session(priority=HIGH)
+    day = None
+    previous_df = None
+    previous_predictions = None
+    pending = list()
+    last_flush = time.monotonic()
+    try:
+        while True:
+            start = time.monotonic()
+            now = datetime.now(UTC)
+            if day_string(now) != day:
+                if pending:
+                    write_shard(pl.concat(reversed(pending)), last_now)
+                    pending = list()
+                day = day_string(now)
+                # All the rows and predictions of the new day must be written to its shards.
+                previous_df = None
+                previous_predictions = None
+                start_compaction(now)
+            try:
+                calls = poll(session, now, capture)
+                if calls is not None:
+                    if predictions:
+                        previous_predictions = record_predictions(
+                            calls, now, previous_predictions
+                        )
+                    df = calls.filter(is_passed(now))
+                    changes = changed_rows(df, previous_df)
+                    previous_df = df
+                    print(f"{len(df)} rows, {len(changes)} new or updated")
+                    if len(changes):
+                        pending.append(changes)
+                    last_now = now
+            except requests.RequestException as e:
+                print("Warning. Request failed!")
+                print(e)
+            except Exception as e:
+                # E.g. a malformed response: the daemon goes on with the next poll.
+                print("Warning. Failed to process the response!")
+                print(e)
+            if pending and time.monotonic() - last_flush >= flush_interval:
+                print(f"Writing {write_shard(pl.concat(reversed(pending)), last_now)}")
+                pending = list()
+                last_flush = time.monotonic()
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pending:
+            write_shard(pl.concat(reversed(pending)), last_now)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--daemon", action="store_true", help="poll the API continuously instead of only once"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=INTERVAL, help="seconds between two requests"
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=FLUSH_INTERVAL,
+        help="seconds between two writes of the new stop times",
+    )
+    parser.add_argument(
+        "--predictions",
+        action="store_true",
+        help="also record the changes of the expected times of the future calls",
+    )
+    parser.add_argument(
+        "--capture", action="store_true", help="archive the raw responses in `data/raw/`"
+    )
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon(args.interval, args.flush_interval, args.predictions, args.capture)
+    else:
+        run_once(args.predictions, args.capture)
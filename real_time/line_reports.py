@@ -0,0 +1,116 @@
+from datetime import datetime
+
+import pytz
+import polars as pl
+
+# Parsing of the Navitia `line_reports` responses into disruptions (used by `traffic-messages.py`
+# and to replay the raw responses).
+
+tz = pytz.timezone("Europe/Paris")
+
+params = {
+    "disable_geojson": True,
+    #  "until": now_str,
+}
+
+stop_struct = pl.Struct({"id": pl.String, "name": pl.String})
+schema = {
+    "id": pl.String,
+    "line": pl.String,
+    "start": pl.Datetime,
+    "end": pl.Datetime,
+    "cause": pl.String,
+    "category": pl.String,
+    "severity": pl.Struct(
+        {"name": pl.String, "effect": pl.String, "color": pl.String, "priority": pl.Int64}
+    ),
+    "tags": pl.List(pl.String),
+    "title": pl.String,
+    "message": pl.String,
+    "from_to": pl.List(pl.Struct({"from": stop_struct, "to": stop_struct})),
+}
+
+
+def is_valid_disruption(disruption: dict):
+    return (
+        (disruption["status"] == "active")
+        and ("Ascenseur" not in disruption.get("tags", []))
+        and (disruption.get("category") != "Communication")
+    )
+
+
+def get_from_to_stops(impacted_object: dict):
+    inner = None
+    if "impacted_rail_section" in impacted_object:
+        inner = impacted_object["impacted_rail_section"]
+    if "impacted_section" in impacted_object:
+        inner = impacted_object["impacted_section"]
+    if inner is None:
+        return
+    if "from" not in inner or "to" not in inner:
+        return None
+    from_stop = inner["from"]
+    to_stop = inner["to"]
+    return {
+        "from": {
+            "id": from_stop["id"],
+            "name": from_stop["name"],
+        },
+        "to": {
+            "id": to_stop["id"],
+            "name": to_stop["name"],
+        },
+    }
+
+
+def is_valid_period(period: dict, now: datetime):
+    begin = datetime.fromisoformat(period["begin"]).astimezone(tz)
+    end = datetime.fromisoformat(period["end"]).astimezone(tz)
+    return begin <= now and end >= now
+
+
+def read_disruptions(data, line, now):
+    disruptions = list()
+    for disruption in filter(is_valid_disruption, data["disruptions"]):
+        title = next(
+            map(
+                lambda m: m["text"],
+                filter(lambda m: m["channel"]["name"] == "titre", disruption["messages"]),
+            )
+        )
+        message = next(
+            map(
+                lambda m: m["text"],
+                filter(lambda m: m["channel"]["name"] == "moteur", disruption["messages"]),
+            )
+        )
+        impacted_objects = filter(
+            lambda o: o["pt_object"]["id"] == f"line:IDFM:{line}",
+            disruption["impacted_objects"],
+        )
+        from_to_stops = list(
+            filter(lambda x: x is not None, map(get_from_to_stops, impacted_objects))
+        )
+        try:
+            period = next(
+                filter(lambda p: is_valid_period(p, now), disruption["application_periods"])
+            )
+        except StopIteration:
+            begin = None
+        else:
+            begin = datetime.fromisoformat(period["begin"]).astimezone(tz)
+        x = {
+            "id": disruption["disruption_id"],
+            "line": line,
+            "start": begin,
+            "end": now,
+            "cause": disruption["cause"],
+            "category": disruption["category"],
+            "severity": disruption["severity"],
+            "tags": disruption.get("tags", []),
+            "title": title,
+            "message": message,
+            "from_to": from_to_stops,
+        }
+        disruptions.append(x)
+    return disruptions
@@ -0,0 +1,203 @@
+import os
+import sys
+import argparse
+from datetime import date, timedelta
+
+import polars as pl
+
+from storage import DATA_DIR, scan_day, write_parquet_atomic
+
+# The GTFS store (see `gtfs_to_parquet.py` and `stop_times.py`) is at the root of the repository.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from stop_times import scan_stop_times  # noqa: E402
+
+# Matching of the real-time stop times of a day with the trips of the IDFM GTFS timetable.
+# Each observed call is first matched with the scheduled stop time of the same route and stop whose
+# time is the nearest to its aimed time (within `TOLERANCE`), with an as-of join. Each journey is
+# then assigned the trip matched by most of its calls, and its calls are joined with the stop times
+# of that trip.
+IDFM_SLUG = "reseau-urbain-et-interurbain-dile-de-france-mobilites"
+GTFS_DIR = os.path.join(ROOT_DIR, "data", IDFM_SLUG)
+
+MATCHING_DIR = os.path.join(DATA_DIR, "matching")
+
+TIMEZONE = "Europe/Paris"
+TOLERANCE = "2m"
+
+# STIF:Line::C01742: -> IDFM:C01742 (and stop 463158 -> IDFM:463158).
+LINE_PATTERN = r"^STIF:Line::(C\d+):$"
+
+
+def gtfs_route_id(col):
+    return pl.format("IDFM:{}", pl.col(col).cast(pl.String).str.extract(LINE_PATTERN))
+
+
+def gtfs_stop_id(col):
+    return pl.format("IDFM:{}", pl.col(col))
+
+
+def gtfs_datetime(col):
+    # GTFS times are measured from noon minus 12 hours (local time) of the service date, which is
+    # different from midnight on the days of the DST changes.
+    noon = (pl.col("date").cast(pl.Datetime("us")) + pl.duration(hours=12)).dt.replace_time_zone(
+        TIMEZONE
+    )
+    return (noon + pl.duration(hours=-12, seconds=pl.col(col))).dt.convert_time_zone("UTC")
+
+
+def scan_observations(day, data_dir=DATA_DIR):
+    return (
+        scan_day(day, data_dir)
+        .with_columns(
+            route=gtfs_route_id("line_ref"),
+            stop=gtfs_stop_id("stop_id"),
+            time=pl.col("aim_dep_time").fill_null(pl.col("aim_arr_time")),
+        )
+        .drop_nulls(["route", "stop", "time"])
+    )
+
+
+def scan_schedule(day, routes, gtfs_dir=GTFS_DIR):
+    # Scheduled stop times of `routes` (original GTFS ids) from the service dates `day - 1` (for the
+    # trips after midnight) and `day`.
+    day = date.fromisoformat(day)
+    gtfs_routes = (
+        pl.scan_parquet(os.path.join(gtfs_dir, "routes.parquet"))
+        .select("route_id", route="original_route_id")
+        .filter(pl.col("route").is_in(routes))
+    )
+    gtfs_stops = pl.scan_parquet(os.path.join(gtfs_dir, "stops.parquet")).select(
+        "stop_id", stop="original_stop_id"
+    )
+    return (
+        scan_stop_times(gtfs_dir, day - timedelta(days=1), day)
+        .join(gtfs_routes, on="route_id")
+        .join(gtfs_stops, on="stop_id")
+        .select(
+            "route",
+            "stop",
+            "trip_id",
+            "date",
+            "stop_sequence",
+            sched_arr_time=gtfs_datetime("arrival_time"),
+            sched_dep_time=gtfs_datetime("departure_time"),
+        )
+    )
+
+
+def assign_trips(observations, schedule, tolerance=TOLERANCE):
+    # Trip (`trip_id`, `date`) of each journey. A trip is only assigned to the journey with the most
+    # matched calls.
+    calls = observations.select("journey_ref", "route", "stop", "time").sort("time")
+    stop_times = schedule.select(
+        "route", "stop", "trip_id", "date", time="sched_dep_time"
+    ).sort("time")
+    return (
+        calls.join_asof(
+            stop_times,
+            on="time",
+            by=["route", "stop"],
+            strategy="nearest",
+            tolerance=tolerance,
+        )
+        .drop_nulls("trip_id")
+        .group_by("journey_ref", "trip_id", "date")
+        .agg(n_matched=pl.len())
+        .sort("n_matched", "journey_ref", "trip_id", descending=[True, False, False])
+        .unique(subset="journey_ref", keep="first", maintain_order=True)
+        .unique(subset=["trip_id", "date"], keep="first", maintain_order=True)
+    )
+
+
+def match_day(day, data_dir=DATA_DIR, gtfs_dir=GTFS_DIR, tolerance=TOLERANCE):
+    # Returns:
+    # - the observed calls with their trip and scheduled times (null if the journey was not
+    #   matched);
+    # - the scheduled trips of the observed routes during the observed period, with their status:
+    #   `observed`, `cancelled` (all the calls of the journey are cancelled) or `missing` (no
+    #   journey was matched with the trip).
+    observations = scan_observations(day, data_dir).collect()
+    routes = observations["route"].unique()
+    schedule = scan_schedule(day, routes, gtfs_dir).collect()
+    assignments = assign_trips(observations, schedule, tolerance)
+    calls = (
+        observations.join(assignments, on="journey_ref", how="left")
+        .join(
+            schedule.unique(subset=["trip_id", "date", "stop"], keep="first").drop("route"),
+            on=["trip_id", "date", "stop"],
+            how="left",
+        )
+        .with_columns(
+            arr_delay=(pl.col("exp_arr_time") - pl.col("sched_arr_time")).dt.total_seconds(),
+            dep_delay=(pl.col("exp_dep_time") - pl.col("sched_dep_time")).dt.total_seconds(),
+        )
+    )
+    journeys = (
+        calls.drop_nulls("trip_id")
+        .group_by("trip_id", "date")
+        .agg(
+            pl.col("journey_ref").first(),
+            is_cancelled=(
+                (pl.col("dep_status") == "cancelled") | (pl.col("arr_status") == "cancelled")
+            )
+            .fill_null(False)
+            .all(),
+        )
+    )
+    start, end = observations["time"].min(), observations["time"].max()
+    trips = (
+        schedule.group_by("route", "trip_id", "date")
+        .agg(
+            first_time=pl.col("sched_dep_time").min(), last_time=pl.col("sched_arr_time").max()
+        )
+        .filter(pl.col("last_time") >= start, pl.col("first_time") <= end)
+        .join(journeys, on=["trip_id", "date"], how="left")
+        .with_columns(
+            status=pl.when(pl.col("journey_ref").is_null())
+            .then(pl.lit("missing"))
+            .when("is_cancelled")
+            .then(pl.lit("cancelled"))
+            .otherwise(pl.lit("observed"))
+        )
+        .drop("is_cancelled")
+        .sort("route", "first_time")
+    )
+    return calls, trips
+
+
+def summary(calls, trips):
+    journeys = calls.group_by("line_ref", "journey_ref").agg(
+        is_matched=pl.col("trip_id").is_not_null().any()
+    )
+    return (
+        journeys.group_by("line_ref")
+        .agg(journeys=pl.len(), unmatched=(~pl.col("is_matched")).sum())
+        .with_columns(route=gtfs_route_id("line_ref"))
+        .join(
+            trips.pivot("status", index="route", values="trip_id", aggregate_function="len"),
+            on="route",
+            how="left",
+        )
+        .drop("route")
+        .sort("line_ref")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("days", nargs="+", help="days to match (YYYY-MM-DD)")
+    parser.add_argument("--gtfs-dir", default=GTFS_DIR)
+    parser.add_argument("--tolerance", default=TOLERANCE, help="e.g. 90s, 2m")
+    parser.add_argument("--output-dir", default=MATCHING_DIR)
+    args = parser.parse_args()
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    for day in args.days:
+        calls, trips = match_day(day, gtfs_dir=args.gtfs_dir, tolerance=args.tolerance)
+        write_parquet_atomic(calls, os.path.join(args.output_dir, f"{day}-calls.parquet"))
+        write_parquet_atomic(trips, os.path.join(args.output_dir, f"{day}-trips.parquet"))
+        with pl.Config(tbl_rows=-1):
+            print(day)
+            print(summary(calls, trips))
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import polars as pl
+
+from storage import DATA_DIR, daily_filename, list_days, list_shards, write_parquet_atomic
+from schema import normalize
+from predictions import PREDICTIONS_DIR, STATE_FILENAME, normalize_predictions
+
+# Converts the stored stop times and predictions to the types of `schema.py`.
+# Usage: python migrate.py [DAY ...]
+# By default, all the days are converted. The files which are already converted are unchanged.
+
+
+def migrate_file(filename, convert=normalize):
+    # Returns the sizes of the file before and after, and the number of rows whose stop is not a
+    # quay (they keep their `stop_ref`).
+    size = os.path.getsize(filename)
+    df = convert(pl.read_parquet(filename))
+    write_parquet_atomic(df, filename)
+    return size, os.path.getsize(filename), df["stop_ref"].is_not_null().sum()
+
+
+def migrate_day(day, data_dir=DATA_DIR, convert=normalize):
+    filenames = list_shards(day, data_dir)
+    if os.path.isfile(daily_filename(day, data_dir)):
+        filenames.append(daily_filename(day, data_dir))
+    sizes = [migrate_file(f, convert) for f in filenames]
+    before, after = sum(s[0] for s in sizes), sum(s[1] for s in sizes)
+    print(f"{day}: {len(filenames)} files, {before:,} -> {after:,} bytes")
+    n_refs = sum(s[2] for s in sizes)
+    if n_refs:
+        print(f"Warning. {n_refs:,} rows at stops which are not quays, kept with their reference")
+
+
+if __name__ == "__main__":
+    for data_dir, convert in ((DATA_DIR, normalize), (PREDICTIONS_DIR, normalize_predictions)):
+        if not os.path.isdir(data_dir):
+            continue
+        print(data_dir)
+        for day in sys.argv[1:] if len(sys.argv) > 1 else list_days(data_dir):
+            migrate_day(day, data_dir, convert)
+        if data_dir == PREDICTIONS_DIR and os.path.isfile(STATE_FILENAME):
+            migrate_file(STATE_FILENAME, convert)
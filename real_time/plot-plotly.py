@@ -1,16 +1,17 @@
 import os
 from datetime import time
-import itertools
 
 import plotly.express as px
-import numpy as np
-import networkx as nx
 import polars as pl
 import matplotlib.pyplot as plt
 
+from storage import scan_day
+from stop_refs import read_stop_table
+from topology import cached_topology, shortest_path
+from plot import EXTRA_EDGES, ORIGINS
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-DATA_DIR = os.path.join(BASE_DIR, "data")
 GRAPH_DIR = os.path.join(BASE_DIR, "graphs")
 if not os.path.isdir(GRAPH_DIR):
     os.makedirs(GRAPH_DIR)
@@ -31,7 +32,7 @@ TO = "vincennes"
 COLOR = "red"
 
 df = (
-    pl.scan_parquet(os.path.join(DATA_DIR, f"{DATE}.parquet"))
+    scan_day(DATE)
     .filter(pl.col("line_ref") == LINE)
     .filter(pl.col("exp_arr_time").is_not_null() | pl.col("exp_dep_time").is_not_null())
     .with_columns(
@@ -68,79 +69,44 @@ df = (
     #  )
 )
 
-stops = pl.scan_parquet(os.path.join(BASE_DIR, "idf", "arrets.parquet")).with_columns(
-    stop_ref=pl.lit("STIF:StopPoint:Q:") + pl.col("arrid") + pl.lit(":")
-)
-
-df = df.join(stops, on="stop_ref")
+df = df.join(read_stop_table().lazy(), on="stop_id")
 
 df = df.sort("aim_arr_time", "aim_dep_time", "mean_time")
 
 df = df.with_columns(
-    is_from=(pl.col("arrname").str.to_lowercase() == FROM.lower()).cast(pl.UInt8),
-    is_to=(pl.col("arrname").str.to_lowercase() == TO.lower()).cast(pl.UInt8),
+    is_from=(pl.col("stop_name").str.to_lowercase() == FROM.lower()).cast(pl.UInt8),
+    is_to=(pl.col("stop_name").str.to_lowercase() == TO.lower()).cast(pl.UInt8),
 )
 
-df = df.group_by("journey_ref").agg(
-    "arrname", "mean_time", "exp_arr_time", "exp_dep_time", "aim_arr_time", "aim_dep_time"
+df = df.with_columns(stop=pl.col("stop_name").str.to_lowercase()).collect()
+
+# Same parameters as `plot.py` so that both scripts share the cached topology of the line.
+topology = cached_topology(
+    LINE, DATE, df, "stop", EXTRA_EDGES.get(LINE, ()), origin=ORIGINS.get(LINE)
 )
 
-df = df.collect()
+df = df.group_by("journey_ref").agg(
+    "stop_name", "mean_time", "exp_arr_time", "exp_dep_time", "aim_arr_time", "aim_dep_time"
+)
 
 print(f"Number of journey: {len(df):,}")
 
-# Find all stop pairs on the line.
-direct_connections = set()
-indirect_connections = set()
-for journey in df.partition_by("journey_ref"):
-    trip_stops = np.array(journey["arrname"][0])
-    unique, idx, counts = np.unique(trip_stops, return_counts=True, return_index=True)
-    idx.sort()
-    uniques = trip_stops[idx]
-    looped_stops = set(unique[counts > 1])
-    direct_connections |= {f"{a}->{b}" for a, b in itertools.pairwise(uniques)}
-    indirect_connections |= {
-        f"{a}->{b}"
-        for i, a in enumerate(trip_stops[:-2])
-        for b in trip_stops[i + 2 :]
-        if a not in looped_stops and b not in looped_stops
-    }
-    if "Concorde->Champs-Élysées - Clemenceau" in indirect_connections:
-        break
-
-connections = direct_connections.difference(indirect_connections)
-
-# Find the path FROM -> TO.
-G = nx.DiGraph()
-for pair in connections:
-    a, b = pair.split("->")
-    G.add_edge(a.lower(), b.lower())
-
-# FIXME: Required for RER A.
-if LINE == "STIF:Line::C01742:":
-    G.add_edge("houilles - carrières-sur-seine", "nanterre - préfecture")
-    G.add_edge("nanterre - préfecture", "houilles - carrières-sur-seine")
-
-# FIXME: Only one direction is added some times.
-for a, b in G.edges():
-    G.add_edge(b, a)
-
-fwd_path = nx.dijkstra_path(G, FROM.lower(), TO.lower())
+fwd_path = shortest_path(topology, FROM.lower(), TO.lower())
 bwd_path = fwd_path[::-1]
 fwd_path_idx = {s: i for i, s in enumerate(fwd_path)}
 bwd_path_idx = {s: i for i, s in enumerate(bwd_path)}
 
 df = (
     df.lazy()
-    .explode("arrname", "exp_arr_time", "exp_dep_time")
-    .filter(pl.col("arrname").str.to_lowercase().is_in(fwd_path))
+    .explode("stop_name", "exp_arr_time", "exp_dep_time")
+    .filter(pl.col("stop_name").str.to_lowercase().is_in(fwd_path))
     .group_by("journey_ref")
-    .agg("arrname", "exp_arr_time", "exp_dep_time")
+    .agg("stop_name", "exp_arr_time", "exp_dep_time")
     .collect()
 )
 
 df = df.with_columns(
-    stop_diff=pl.col("arrname")
+    stop_diff=pl.col("stop_name")
     .list.eval(pl.element().str.to_lowercase().replace_strict(fwd_path_idx))
     .list.diff()
     .list.max()
@@ -151,13 +117,13 @@ df = df.with_columns(
     .then(pl.lit("backward"))
 )
 
-df = df.explode("arrname", "exp_arr_time", "exp_dep_time")
+df = df.explode("stop_name", "exp_arr_time", "exp_dep_time")
 # TODO: keep case
-df = df.with_columns(pl.col("arrname").str.to_lowercase())
+df = df.with_columns(pl.col("stop_name").str.to_lowercase())
 data = pl.concat(
     (
-        df.select("journey_ref", "arrname", "direction", time="exp_arr_time"),
-        df.select("journey_ref", "arrname", "direction", time="exp_dep_time"),
+        df.select("journey_ref", "stop_name", "direction", time="exp_arr_time"),
+        df.select("journey_ref", "stop_name", "direction", time="exp_dep_time"),
     ),
     how="vertical",
 ).sort("journey_ref", "time")
@@ -165,7 +131,7 @@ data = pl.concat(
 fig = px.line(
     data.filter(direction="forward"),
     x="time",
-    y="arrname",
+    y="stop_name",
     line_group="journey_ref",
     markers=True,
     hover_name="journey_ref",
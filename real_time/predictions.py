@@ -0,0 +1,132 @@
+import os
+import re
+
+import polars as pl
+
+from storage import DATA_DIR, day_string, scan_day, write_parquet_atomic, write_shard
+from schema import STOP_PATTERN, journey_id, journey_id_of, normalize, with_journey_id
+
+# The expected times of all the calls (including the future ones) are stored as deltas: a row is
+# written only when the prediction for a (journey, stop) pair changes. The rows are sharded like the
+# stop times, in `data/predictions/`.
+PREDICTIONS_DIR = os.path.join(DATA_DIR, "predictions")
+
+# The journeys are identified by the hash of their reference (see `schema.py`).
+KEY = ["journey_id", "stop_id", "stop_ref"]
+PREDICTION_COLUMNS = ["exp_arr_time", "exp_dep_time"]
+# Predictions are deduplicated on this key when a day is compacted.
+SHARD_KEY = KEY + ["observed_at"]
+
+# Predictions of the previous poll, used by the collectors that do not run continuously.
+STATE_FILENAME = os.path.join(PREDICTIONS_DIR, "state.parquet")
+
+
+def normalize_predictions(df):
+    # The predictions written by older versions have journey and stop references.
+    return with_journey_id(normalize(df))
+
+
+def select_predictions(calls, now):
+    return calls.select(
+        "line_ref",
+        journey_id(),
+        "stop_id",
+        "stop_ref",
+        pl.lit(now).dt.cast_time_unit("us").alias("observed_at"),
+        *PREDICTION_COLUMNS,
+    )
+
+
+def prediction_changes(predictions, previous_predictions):
+    # Predictions which differ from the previous poll (or which were not in the previous poll).
+    if previous_predictions is None:
+        return predictions
+    return predictions.join(
+        previous_predictions, on=KEY + PREDICTION_COLUMNS, how="anti", join_nulls=True
+    )
+
+
+def read_state(now):
+    # The state of a previous day is not used: all the predictions of a new day must be written to
+    # its shards.
+    if not os.path.isfile(STATE_FILENAME):
+        return None
+    state = normalize_predictions(pl.read_parquet(STATE_FILENAME))
+    if state.is_empty() or day_string(state["observed_at"].max()) != day_string(now):
+        return None
+    return state
+
+
+def record_predictions(calls, now, previous_predictions=None):
+    # Writes the changed predictions to a new shard and returns the predictions of this poll, to be
+    # given as `previous_predictions` for the next poll.
+    predictions = select_predictions(calls, now)
+    changes = prediction_changes(predictions, previous_predictions)
+    if len(changes):
+        write_shard(changes, now, PREDICTIONS_DIR)
+    return predictions
+
+
+def record_predictions_once(calls, now):
+    if not os.path.isdir(PREDICTIONS_DIR):
+        os.makedirs(PREDICTIONS_DIR)
+    predictions = record_predictions(calls, now, read_state(now))
+    write_parquet_atomic(predictions, STATE_FILENAME)
+
+
+def scan_predictions(day):
+    return scan_day(day, PREDICTIONS_DIR, key=SHARD_KEY, convert=normalize_predictions)
+
+
+def prediction_timeline(day, journey_ref=None, stop_ref=None):
+    # One row per prediction, valid from `observed_at` until `valid_until` (null for the last
+    # prediction of a call).
+    # Rows identical to the previous prediction of the same call are possible when a journey
+    # disappears from the feed and reappears, they are removed.
+    df = scan_predictions(day)
+    if journey_ref is not None:
+        df = df.filter(pl.col("journey_id") == journey_id_of(journey_ref))
+    if stop_ref is not None:
+        match = re.match(STOP_PATTERN, stop_ref)
+        if match is not None:
+            df = df.filter(pl.col("stop_id") == int(match.group(1)))
+        else:
+            df = df.filter(pl.col("stop_ref") == stop_ref)
+    return (
+        df.sort(*KEY, "observed_at")
+        .filter(
+            pl.any_horizontal(
+                pl.col(c).ne_missing(pl.col(c).shift(1).over(KEY)) for c in PREDICTION_COLUMNS
+            )
+            | pl.col("observed_at").shift(1).over(KEY).is_null()
+        )
+        .with_columns(valid_until=pl.col("observed_at").shift(-1).over(KEY))
+        .collect()
+    )
+
+
+def prediction_errors(day):
+    # Error of each prediction with respect to the final recorded times of the call, and time
+    # between the prediction and the actual arrival (`horizon`).
+    actual = scan_day(day).select(
+        journey_id(),
+        "stop_id",
+        "stop_ref",
+        pl.col("exp_arr_time").alias("actual_arr_time"),
+        pl.col("exp_dep_time").alias("actual_dep_time"),
+    )
+    return (
+        prediction_timeline(day)
+        .lazy()
+        .join(actual, on=KEY, join_nulls=True)
+        .with_columns(
+            arr_error=(pl.col("exp_arr_time") - pl.col("actual_arr_time")).dt.total_seconds(),
+            dep_error=(pl.col("exp_dep_time") - pl.col("actual_dep_time")).dt.total_seconds(),
+            horizon=(
+                pl.col("actual_arr_time").fill_null(pl.col("actual_dep_time"))
+                - pl.col("observed_at")
+            ).dt.total_seconds(),
+        )
+        .collect()
+    )
+
@@ -0,0 +1,69 @@
+import os
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from scheduler import NORMAL, acquire, report_rate_limited
+
+# The API URL and key can be overridden with environment variables (e.g. to use `mock_servers.py`).
+API_URL = os.environ.get("PRIM_API_URL", "https://prim.iledefrance-mobilites.fr/marketplace")
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SECRETS_FILE = os.path.join(BASE_DIR, "..", "secrets.json")
+
+
+def read_api_key():
+    if "PRIM_API_KEY" in os.environ:
+        return os.environ["PRIM_API_KEY"]
+    if os.path.isfile(SECRETS_FILE):
+        with open(SECRETS_FILE, "r") as f:
+            secrets = json.load(f)
+            return secrets["api_key"]
+    else:
+        raise Exception(f"Cannot read API Key from `{SECRETS_FILE}`")
+
+
+class ScheduledSession(requests.Session):
+    # Each request waits for a token of the quota shared by all the collectors (see
+    # `scheduler.py`). The requests which are rate limited (429) are reported to the scheduler and
+    # sent again once it allows it.
+    def __init__(self, priority=NORMAL, retries=0):
+        super().__init__()
+        self.priority = priority
+        self.retries = retries
+
+    def request(self, *args, **kwargs):
+        for _ in range(self.retries + 1):
+            acquire(self.priority)
+            response = super().request(*args, **kwargs)
+            if response.status_code != 429:
+                return response
+            report_rate_limited(response)
+            response.close()
+        return response
+
+
+def new_session(pool_size=None, retries=0, priority=NORMAL):
+    # The session keeps the connections to the API open between requests.
+    # When the session is shared by several threads, `pool_size` should be at least the number of
+    # threads so that each of them can keep its own connection.
+    # Failed requests (connection errors, 429 and 5xx responses) are retried `retries` times, with
+    # an exponential backoff.
+    session = ScheduledSession(priority, retries)
+    session.headers["apiKey"] = read_api_key()
+    if pool_size is not None or retries:
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size or 10,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    return session
@@ -0,0 +1,91 @@
+import os
+import json
+from datetime import datetime, UTC
+
+import zstandard
+
+from storage import DATA_DIR, day_string
+
+# The raw responses of the API can be archived, compressed with zstd, in
+# `data/raw/<kind>/YYYY-MM-DD/<HHMMSSffffff>.json.zst` (the name is the time of the request, in UTC)
+# so that the days can be processed again when the parsing changes (see `replay.py`).
+# The line reports of all the lines requested in one sweep are stored in a single file, as a JSON
+# object mapping the lines to their response.
+RAW_DIR = os.path.join(DATA_DIR, "raw")
+
+ESTIMATED_TIMETABLE = "estimated-timetable"
+LINE_REPORTS = "line-reports"
+
+COMPRESSION_LEVEL = 3
+CHUNK_SIZE = 1 << 20
+
+
+def raw_dir(kind, day, raw_root=RAW_DIR):
+    return os.path.join(raw_root, kind, day)
+
+
+def raw_filename(kind, now, raw_root=RAW_DIR):
+    now = now.astimezone(UTC)
+    directory = raw_dir(kind, day_string(now), raw_root)
+    return os.path.join(directory, f"{now.strftime('%H%M%S%f')}.json.zst")
+
+
+def list_raw_files(kind, day, raw_root=RAW_DIR):
+    directory = raw_dir(kind, day, raw_root)
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith(".json.zst")
+    ]
+
+
+def raw_file_time(filename):
+    day = os.path.basename(os.path.dirname(filename))
+    t = os.path.basename(filename).removesuffix(".json.zst")
+    return datetime.strptime(f"{day} {t}", "%Y-%m-%d %H%M%S%f").replace(tzinfo=UTC)
+
+
+class RawCapture:
+    # Writes a response to its archive file while it is read. The file is only kept if the response
+    # was read completely.
+    def __init__(self, kind, now, raw_root=RAW_DIR):
+        self.filename = raw_filename(kind, now, raw_root)
+
+    def __enter__(self):
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.tmp_filename = f"{self.filename}.tmp"
+        self.file = open(self.tmp_filename, "wb")
+        self.writer = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).stream_writer(self.file)
+        return self
+
+    def tee(self, chunks):
+        for chunk in chunks:
+            self.writer.write(chunk)
+            yield chunk
+
+    def write_json(self, data):
+        self.writer.write(json.dumps(data).encode())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.close()
+        if exc_type is None:
+            os.replace(self.tmp_filename, self.filename)
+        else:
+            os.remove(self.tmp_filename)
+
+
+def iter_raw_chunks(filename, chunk_size=CHUNK_SIZE):
+    with open(filename, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def read_raw_json(filename):
+    with open(filename, "rb") as f:
+        return json.load(zstandard.ZstdDecompressor().stream_reader(f))
@@ -0,0 +1,135 @@
+import numpy as np
+import polars as pl
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+
+# Rendering of the space-time diagrams of a line. The trajectories of all the journeys are built as
+# a whole (with polars and numpy) and drawn as one path per direction and endpoint, instead of one
+# Line2D per journey.
+
+COLORS = mpl.colormaps["Dark2"]
+TIMEZONE = "Europe/Paris"
+UNKNOWN_ENDPOINTS = ["Unknown fwd", "Unknown bwd"]
+
+
+def endpoint_colors(topology):
+    endpoints = topology["endpoints"] + UNKNOWN_ENDPOINTS
+    return {e: COLORS(i % COLORS.N) for i, e in enumerate(endpoints)}
+
+
+def journey_points(df, topology, stop_col="stop"):
+    # `df` has one row per journey and stop, in the order of the journey, with columns
+    # `journey_ref`, `stop_col`, `exp_arr_time` and `exp_dep_time`.
+    # Returns the points (arrival then departure at each stop) of the trajectories with their
+    # coordinates (`x` in matplotlib date units, `y` the position of the stop on the line), the
+    # direction and the endpoint of their journey. The points which go back in time are removed, so
+    # the times of each journey are sorted.
+    fwd_index = {s: i for i, s in enumerate(topology["fwd_path"])}
+    fwd_endpoints = {n: e for e, nodes in topology["fwd_endpoints_nodes"].items() for n in nodes}
+    bwd_endpoints = {n: e for e, nodes in topology["bwd_endpoints_nodes"].items() for n in nodes}
+    journeys = (
+        df.lazy()
+        .select("journey_ref", pl.col(stop_col).alias("stop"), "exp_arr_time", "exp_dep_time")
+        .with_columns(pos=pl.int_range(pl.len()).over("journey_ref"))
+    )
+    directions = (
+        journeys.filter(pl.col("stop").is_in(list(fwd_index)))
+        .group_by("journey_ref")
+        .agg(
+            first=pl.col("stop").first().replace_strict(fwd_index),
+            last=pl.col("stop").last().replace_strict(fwd_index),
+            n_stops=pl.len(),
+        )
+        .select(
+            "journey_ref",
+            "n_stops",
+            is_fwd=pl.col("first") < pl.col("last"),
+            is_bwd=pl.col("first") > pl.col("last"),
+        )
+    )
+    # The endpoint is found from the last stop of the journey.
+    endpoints = journeys.group_by("journey_ref").agg(last_stop=pl.col("stop").last())
+    points = pl.concat(
+        (
+            journeys.select("journey_ref", "stop", time="exp_arr_time", order=2 * pl.col("pos")),
+            journeys.select(
+                "journey_ref", "stop", time="exp_dep_time", order=2 * pl.col("pos") + 1
+            ),
+        ),
+        how="vertical",
+    )
+    return (
+        points.filter(pl.col("stop").is_in(list(fwd_index)))
+        .sort("journey_ref", "order")
+        .filter(pl.col("time") >= pl.col("time").cum_max().over("journey_ref"))
+        .join(directions, on="journey_ref")
+        .join(endpoints, on="journey_ref")
+        .sort("journey_ref", "order")
+        .select(
+            "journey_ref",
+            "is_fwd",
+            "is_bwd",
+            "n_stops",
+            "stop",
+            "time",
+            x=pl.col("time").dt.epoch("us") / (86_400 * 1e6),
+            y=pl.col("stop").replace_strict(topology["time_dict"], return_dtype=pl.Float64),
+            endpoint=pl.when("is_fwd")
+            .then(pl.col("last_stop").replace_strict(fwd_endpoints, default=UNKNOWN_ENDPOINTS[0]))
+            .otherwise(
+                pl.col("last_stop").replace_strict(bwd_endpoints, default=UNKNOWN_ENDPOINTS[1])
+            ),
+        )
+        .collect()
+    )
+
+
+def build_paths(points):
+    # Coordinates of the trajectories of `points` as a single path, the journeys being separated by
+    # NaN values (which is much faster to draw than one line per journey).
+    x = points["x"].to_numpy()
+    y = points["y"].to_numpy()
+    breaks = np.flatnonzero(points["journey_ref"].rle_id().diff().fill_null(0).to_numpy())
+    return np.insert(x, breaks, np.nan), np.insert(y, breaks, np.nan)
+
+
+def draw_trajectories(ax, points, colors, rasterized=True, markers=True):
+    # One path per endpoint.
+    for (endpoint,), group in points.partition_by("endpoint", as_dict=True).items():
+        x, y = build_paths(group)
+        ax.plot(
+            x,
+            y,
+            "-o" if markers else "-",
+            color=colors[endpoint],
+            alpha=0.7,
+            markersize=1.5,
+            linewidth=0.8,
+            rasterized=rasterized,
+        )
+
+
+def render_diagram(df, topology, fwd_title, bwd_title, stop_col="stop", rasterized=True):
+    points = journey_points(df, topology, stop_col)
+    colors = endpoint_colors(topology)
+    n_invalid = points.filter(~pl.col("is_fwd"), ~pl.col("is_bwd"), pl.col("n_stops") > 2)[
+        "journey_ref"
+    ].n_unique()
+    if n_invalid:
+        print(f"Invalid journeys: {n_invalid}")
+    time_dict = topology["time_dict"]
+    fig, axs = plt.subplots(nrows=2, sharex=True, figsize=(19, 20))
+    draw_trajectories(axs[0], points.filter("is_fwd"), colors, rasterized)
+    draw_trajectories(axs[1], points.filter("is_bwd"), colors, rasterized)
+    for ax, title in zip(axs, (fwd_title, bwd_title)):
+        ax.set_yticks(ticks=list(time_dict.values()), labels=list(time_dict.keys()))
+        ax.set_ylim(min(time_dict.values()), max(time_dict.values()))
+        ax.grid()
+        ax.set_title(title)
+    if len(points):
+        axs[0].set_xlim(points["x"].min(), points["x"].max())
+    axs[1].xaxis.set_major_locator(mdates.AutoDateLocator(tz=TIMEZONE))
+    axs[1].xaxis.set_major_formatter(mdates.DateFormatter("%H:%M", tz=TIMEZONE))
+    fig.tight_layout()
+    return fig
@@ -0,0 +1,71 @@
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import polars as pl
+
+from storage import DATA_DIR, KEY, daily_filename, write_parquet_atomic
+from raw import ESTIMATED_TIMETABLE, LINE_REPORTS, list_raw_files, raw_file_time
+from raw import iter_raw_chunks, read_raw_json
+from siri import EstimatedTimetableStream, flatten_estimated_journeys, is_passed
+from line_reports import tz, schema, read_disruptions
+from global_request import lines
+
+# Processes the archived raw responses of some days again (see `raw.py`), with the current parsing
+# code. The files of a day are parsed in parallel then merged like the polls of the collectors.
+# The results are written to `data/replay/` by default so that the collected data is not replaced
+# unless asked.
+OUTPUT_DIR = os.path.join(DATA_DIR, "replay")
+
+N_WORKERS = 8
+
+
+def replay_estimated_timetable_file(filename):
+    now = raw_file_time(filename)
+    calls = flatten_estimated_journeys(EstimatedTimetableStream(iter_raw_chunks(filename), lines))
+    return calls.filter(is_passed(now))
+
+
+def replay_line_reports_file(filename):
+    now = raw_file_time(filename).astimezone(tz)
+    responses = read_raw_json(filename)
+    disruptions = [x for line, data in responses.items() for x in read_disruptions(data, line, now)]
+    return pl.DataFrame(disruptions, schema=schema)
+
+
+def replay_day(kind, day, executor, output_dir=OUTPUT_DIR):
+    files = list_raw_files(kind, day)
+    if not files:
+        print(f"Warning. No raw {kind} file for day {day}")
+        return None
+    if kind == ESTIMATED_TIMETABLE:
+        function = replay_estimated_timetable_file
+        key = KEY
+        output_filename = daily_filename(day, output_dir)
+    else:
+        function = replay_line_reports_file
+        key = ["id"]
+        output_filename = os.path.join(output_dir, f"traffic-{day}.parquet")
+    # The results are in chronological order so the most recent record of each key is kept.
+    df = pl.concat(executor.map(function, files, chunksize=4), how="vertical").unique(
+        subset=key, keep="last", maintain_order=True
+    )
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    write_parquet_atomic(df, output_filename)
+    print(f"{day}: {len(files)} files, {len(df)} rows")
+    return output_filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", choices=[ESTIMATED_TIMETABLE, LINE_REPORTS])
+    parser.add_argument("days", nargs="+", help="days to replay (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    args = parser.parse_args()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        for day in args.days:
+            replay_day(args.kind, day, executor, args.output_dir)
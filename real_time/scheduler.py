@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import fcntl
+from datetime import datetime, timedelta, UTC
+from email.utils import parsedate_to_datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# All the collectors share the same API key, and thus the same quota. The state of the quota is
+# stored in a file so that the collectors running in different processes (and the threads of a
+# collector) draw from a single token bucket. The file is locked while it is read and updated.
+STATE_FILENAME = os.path.join(BASE_DIR, "data", "quota.json")
+
+# Maximum sustained rate (requests per second) and maximum number of requests sent in a burst.
+RATE = 5.0
+BURST = 20
+# Number of requests allowed per day (the quota window, reset at midnight UTC). The refill rate is
+# reduced when needed so that the remaining requests are spread until the end of the window.
+DAILY_QUOTA = 1_000_000
+
+# Priorities of the requests: a request can only take a token if, after taking it, at least
+# `RESERVE[priority]` tokens are left in the bucket, so that the requests of lower priority never
+# use the last tokens and the requests of higher priority are not delayed during bursts.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+RESERVE = {HIGH: 0, NORMAL: 0.25 * BURST, LOW: 0.5 * BURST}
+
+# Time (in seconds) during which no request is sent after a 429 response without a `Retry-After`
+# header.
+DEFAULT_BACKOFF = 30
+
+
+def window_end(now):
+    return (datetime.fromtimestamp(now, UTC) + timedelta(days=1)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    ).timestamp()
+
+
+class QuotaState:
+    # Context manager giving exclusive access to the state of the quota.
+    def __init__(self, filename=STATE_FILENAME):
+        self.filename = filename
+
+    def __enter__(self):
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.filename, "a+")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.file.seek(0)
+        try:
+            self.state = json.load(self.file)
+        except ValueError:
+            self.state = dict()
+        now = time.time()
+        if self.state.get("window_end", 0) <= now:
+            self.state["window_end"] = window_end(now)
+            self.state["n_requests"] = 0
+        self.state.setdefault("tokens", BURST)
+        self.state.setdefault("updated", now)
+        self.state.setdefault("blocked_until", 0)
+        self.refill(now)
+        return self.state
+
+    def refill(self, now):
+        remaining = max(0, DAILY_QUOTA - self.state["n_requests"])
+        rate = min(RATE, remaining / max(1.0, self.state["window_end"] - now))
+        elapsed = max(0.0, now - self.state["updated"])
+        self.state["tokens"] = min(BURST, self.state["tokens"] + elapsed * rate)
+        self.state["updated"] = now
+        self.state["rate"] = rate
+
+    def __exit__(self, *args):
+        self.file.seek(0)
+        self.file.truncate()
+        json.dump(self.state, self.file)
+        self.file.flush()
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def try_acquire(priority=NORMAL, filename=STATE_FILENAME):
+    # Returns 0 if a request can be sent now (the token is taken), otherwise the number of seconds
+    # to wait before trying again.
+    with QuotaState(filename) as state:
+        now = time.time()
+        if state["blocked_until"] > now:
+            return state["blocked_until"] - now
+        if state["n_requests"] >= DAILY_QUOTA:
+            return state["window_end"] - now
+        missing = 1 + RESERVE[priority] - state["tokens"]
+        if missing > 0:
+            if state["rate"] <= 0:
+                return state["window_end"] - now
+            return missing / state["rate"]
+        state["tokens"] -= 1
+        state["n_requests"] += 1
+        return 0
+
+
+def acquire(priority=NORMAL, filename=STATE_FILENAME):
+    while True:
+        wait = try_acquire(priority, filename)
+        if wait <= 0:
+            return
+        time.sleep(wait)
+
+
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return DEFAULT_BACKOFF
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return DEFAULT_BACKOFF
+
+
+def report_rate_limited(response, filename=STATE_FILENAME):
+    # A 429 response means that the quota is used by another client or that the real limits are
+    # lower than the configured ones: the bucket is emptied and no request is sent before the time
+    # given by the server.
+    with QuotaState(filename) as state:
+        state["tokens"] = 0
+        state["blocked_until"] = max(state["blocked_until"], time.time() + retry_after(response))
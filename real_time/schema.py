@@ -0,0 +1,144 @@
+import hashlib
+
+import polars as pl
+
+# Types of the columns of the real-time stop times and predictions.
+# - The stops are identified by the integer id of their quay (`STIF:StopPoint:Q:<id>:`, see
+#   `stop_refs.py` for the names). `stop_ref` is only kept for the other stops (null otherwise), so
+#   the stops are identified by (`stop_id`, `stop_ref`).
+# - The predictions identify the journeys by `journey_id`, a 64-bit hash of the journey reference
+#   which does not depend on the day or on the process.
+# - The lines and the call statuses have enums with a fixed dictionary, but the files keep them as
+#   strings (which parquet already stores with a dictionary): polars 1.19 panics when it reads an
+#   enum column without nulls and with several values from a file while a filter on another column
+#   is pushed down to the scan (see `bench_schema.py`).
+# The older files are converted when they are read, or once for all with `migrate.py`.
+
+# Lines tracked by the collectors. The enum of the lines is built from this list: the lines that
+# are not tracked anymore must not be removed, since they can be in the stored files.
+LINE_REFS = [
+    "STIF:Line::C01372:",
+    "STIF:Line::C01374:",
+    "STIF:Line::C01378:",
+    "STIF:Line::C01381:",
+    "STIF:Line::C01383:",
+    "STIF:Line::C01391:",
+    "STIF:Line::C01738:",
+    "STIF:Line::C01744:",
+    "STIF:Line::C01747:",
+    "STIF:Line::C02375:",
+    "STIF:Line::C01371:",
+    "STIF:Line::C01382:",
+    "STIF:Line::C01386:",
+    "STIF:Line::C01679:",
+    "STIF:Line::C01746:",
+    "STIF:Line::C01795:",
+    "STIF:Line::C01843:",
+    "STIF:Line::C01857:",
+    "STIF:Line::C02368:",
+    "STIF:Line::C02370:",
+    "STIF:Line::C02711:",
+    "STIF:Line::C00563:",
+    "STIF:Line::C01375:",
+    "STIF:Line::C01390:",
+    "STIF:Line::C01728:",
+    "STIF:Line::C01729:",
+    "STIF:Line::C01731:",
+    "STIF:Line::C01736:",
+    "STIF:Line::C01737:",
+    "STIF:Line::C01740:",
+    "STIF:Line::C01741:",
+    "STIF:Line::C01742:",
+    "STIF:Line::C01743:",
+    "STIF:Line::C01745:",
+    "STIF:Line::C01774:",
+    "STIF:Line::C01794:",
+    "STIF:Line::C01999:",
+    "STIF:Line::C01376:",
+    "STIF:Line::C01380:",
+    "STIF:Line::C01387:",
+    "STIF:Line::C01388:",
+    "STIF:Line::C01389:",
+    "STIF:Line::C01684:",
+    "STIF:Line::C01739:",
+    "STIF:Line::C02317:",
+    "STIF:Line::C02528:",
+    "STIF:Line::C02732:",
+    "STIF:Line::C01373:",
+    "STIF:Line::C01377:",
+    "STIF:Line::C01379:",
+    "STIF:Line::C01384:",
+    "STIF:Line::C01727:",
+    "STIF:Line::C01730:",
+    "STIF:Line::C01748:",
+    "STIF:Line::C01863:",
+    "STIF:Line::C02344:",
+    "STIF:Line::C02372:",
+    "STIF:Line::C02529:",
+]
+
+# SIRI CallStatusEnumeration.
+STATUSES = [
+    "onTime",
+    "early",
+    "delayed",
+    "cancelled",
+    "arrived",
+    "departed",
+    "missed",
+    "noReport",
+    "notExpected",
+]
+
+LINE_REF_TYPE = pl.Enum(LINE_REFS)
+STATUS_TYPE = pl.Enum(STATUSES)
+
+STOP_PATTERN = r"^STIF:StopPoint:Q:(\d+):$"
+
+
+def stop_id(col="stop_ref"):
+    # Null if the reference is not a quay.
+    return pl.col(col).str.extract(STOP_PATTERN).cast(pl.UInt32).alias("stop_id")
+
+
+def journey_id_of(journey_ref):
+    # `Expr.hash` is not stable across the versions of polars.
+    digest = hashlib.blake2b(journey_ref.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def hash_journey_refs(refs):
+    # Each distinct reference is only hashed once.
+    unique_refs = refs.drop_nulls().unique()
+    ids = pl.Series([journey_id_of(ref) for ref in unique_refs], dtype=pl.UInt64)
+    return refs.replace_strict(unique_refs, ids, default=None, return_dtype=pl.UInt64)
+
+
+def journey_id(col="journey_ref"):
+    return pl.col(col).map_batches(hash_journey_refs, return_dtype=pl.UInt64).alias("journey_id")
+
+
+def with_journey_id(df):
+    # Replaces the journey references by their hashes.
+    names = df.collect_schema().names()
+    if "journey_id" in names or "journey_ref" not in names:
+        return df
+    return df.select(journey_id() if name == "journey_ref" else name for name in names)
+
+
+def normalize(df):
+    # Converts a frame (eager or lazy) to the stored types. It does nothing on frames that are
+    # already converted.
+    names = df.collect_schema().names()
+    if "stop_ref" not in names and "stop_id" not in names:
+        return df
+    stop = pl.col("stop_id").cast(pl.UInt32) if "stop_id" in names else stop_id()
+    if "stop_ref" in names:
+        # The references which are not quays are kept, as they have no `stop_id`.
+        stop_ref = pl.when(stop.is_null()).then(pl.col("stop_ref")).alias("stop_ref")
+    else:
+        stop_ref = pl.lit(None, dtype=pl.String).alias("stop_ref")
+    # The stop columns replace the first of them.
+    position = min(names.index(name) for name in ("stop_ref", "stop_id") if name in names)
+    others = [name for name in names if name not in ("stop_ref", "stop_id")]
+    return df.select(*others[:position], stop, stop_ref, *others[position:])
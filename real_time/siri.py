@@ -0,0 +1,229 @@
+import re
+import json
+import codecs
+
+import numpy as np
+import polars as pl
+
+from schema import normalize
+
+# Incremental parser of the estimated-timetable responses: the `EstimatedVehicleJourney` objects are
+# decoded one by one as the response is received and the journeys of the lines which are not tracked
+# are dropped right away, so that the full response is never held in memory.
+
+CHUNK_SIZE = 1 << 20
+
+JOURNEYS_START = re.compile(r'"EstimatedVehicleJourney"\s*:\s*\[')
+RESPONSE_TIMESTAMP = re.compile(r'"ResponseTimestamp"\s*:\s*"([^"]*)"')
+SEPARATORS = re.compile(r"[\s,]*")
+
+
+class EstimatedTimetableStream:
+    def __init__(self, chunks, lines):
+        self.chunks = chunks
+        self.lines = lines
+        self.response_timestamp = None
+        self.n_journeys = 0
+
+    def __iter__(self):
+        text_decoder = codecs.getincrementaldecoder("utf-8")()
+        json_decoder = json.JSONDecoder()
+        buffer = ""
+        # Position in the buffer up to which the text has been read.
+        pos = 0
+        in_array = False
+        for chunk in self.chunks:
+            buffer += text_decoder.decode(chunk)
+            while True:
+                if not in_array:
+                    if self.response_timestamp is None:
+                        match = RESPONSE_TIMESTAMP.search(buffer, pos)
+                        if match is not None:
+                            self.response_timestamp = match.group(1)
+                    match = JOURNEYS_START.search(buffer, pos)
+                    if match is None:
+                        # Keep the end of the buffer in case the key is split between two chunks.
+                        pos = max(pos, len(buffer) - 128)
+                        break
+                    pos = match.end()
+                    in_array = True
+                pos = SEPARATORS.match(buffer, pos).end()
+                if pos == len(buffer):
+                    break
+                if buffer[pos] == "]":
+                    pos += 1
+                    in_array = False
+                    continue
+                try:
+                    journey, end = json_decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # The journey is not complete yet.
+                    break
+                pos = end
+                self.n_journeys += 1
+                if journey.get("LineRef", dict()).get("value") in self.lines:
+                    yield journey
+            # Drop the text that has already been read.
+            buffer = buffer[pos:]
+            pos = 0
+        if in_array:
+            raise Exception("Incomplete estimated-timetable response")
+
+
+def iter_response_journeys(response, lines, capture=None):
+    # The response must be requested with `stream=True`.
+    # If `capture` is given (a `raw.RawCapture`), the raw response is also archived as it is read.
+    chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+    if capture is not None:
+        chunks = capture.tee(chunks)
+    return EstimatedTimetableStream(chunks, lines)
+
+
+# Columnar flattening of the SIRI journeys: each field of the calls is extracted into a column in
+# one pass, then the timestamps are parsed and filtered with polars expressions instead of being
+# parsed one by one in Python.
+
+CALL_SCHEMA = {
+    "stop_ref": pl.String,
+    "order": pl.Int64,
+    "dep_status": pl.String,
+    "arr_status": pl.String,
+    "exp_dep_time": pl.String,
+    "exp_arr_time": pl.String,
+    "aim_dep_time": pl.String,
+    "aim_arr_time": pl.String,
+}
+TIME_COLUMNS = ["exp_dep_time", "exp_arr_time", "aim_dep_time", "aim_arr_time"]
+JOURNEY_SCHEMA = {
+    "line_ref": pl.String,
+    "journey_ref": pl.String,
+    "dest_ref": pl.String,
+    "dest_name": pl.String,
+    "longtrain": pl.Boolean,
+}
+
+
+def read_calls(calls):
+    return pl.DataFrame(
+        {
+            "stop_ref": [call["StopPointRef"]["value"] for call in calls],
+            "order": [call.get("Order") for call in calls],
+            "dep_status": [call.get("DepartureStatus") for call in calls],
+            "arr_status": [call.get("ArrivalStatus") for call in calls],
+            "exp_dep_time": [call.get("ExpectedDepartureTime") for call in calls],
+            "exp_arr_time": [call.get("ExpectedArrivalTime") for call in calls],
+            "aim_dep_time": [call.get("AimedDepartureTime") for call in calls],
+            "aim_arr_time": [call.get("AimedArrivalTime") for call in calls],
+        },
+        schema=CALL_SCHEMA,
+    ).with_columns(pl.col(TIME_COLUMNS).str.to_datetime(time_zone="UTC"))
+
+
+def read_journeys(journeys):
+    return pl.DataFrame(
+        {
+            "line_ref": [journey["LineRef"]["value"] for journey in journeys],
+            "journey_ref": [journey["DatedVehicleJourneyRef"]["value"] for journey in journeys],
+            "dest_ref": [journey["DestinationRef"]["value"] for journey in journeys],
+            "dest_name": [journey["DestinationName"][0]["value"] for journey in journeys],
+            "longtrain": [
+                journey["VehicleFeatureRef"][0] == "longTrain"
+                if journey.get("VehicleFeatureRef")
+                else None
+                for journey in journeys
+            ],
+        },
+        schema=JOURNEY_SCHEMA,
+    )
+
+
+def is_passed(now):
+    # The calls whose expected arrival and departure times are both in the past.
+    return (pl.col("exp_dep_time").is_null() | (pl.col("exp_dep_time") <= now)) & (
+        pl.col("exp_arr_time").is_null() | (pl.col("exp_arr_time") <= now)
+    )
+
+
+def flatten_estimated_journeys(journeys, now=None):
+    # If `now` is given, only the calls that already passed at that time are returned.
+    journeys = list(journeys)
+    n_calls = [len(journey["EstimatedCalls"]["EstimatedCall"]) for journey in journeys]
+    calls = [call for journey in journeys for call in journey["EstimatedCalls"]["EstimatedCall"]]
+    journey_idx = np.repeat(np.arange(len(journeys)), n_calls)
+    df = pl.concat((read_journeys(journeys)[journey_idx], read_calls(calls)), how="horizontal")
+    if now is not None:
+        df = df.filter(is_passed(now))
+    return normalize(
+        df.select(
+            "line_ref",
+            "journey_ref",
+            "dest_ref",
+            "dest_name",
+            "stop_ref",
+            "longtrain",
+            "dep_status",
+            "arr_status",
+            "exp_dep_time",
+            "exp_arr_time",
+            "aim_dep_time",
+            "aim_arr_time",
+        )
+    )
+
+
+def flatten_monitored_visits(visits, now=None):
+    # If `now` is given, only the visits whose departure (or arrival, if the departure time is
+    # unknown) already passed at that time are returned.
+    journeys = [
+        visit["MonitoredVehicleJourney"]
+        for visit in visits
+        if "MonitoredCall" in visit.get("MonitoredVehicleJourney", dict())
+    ]
+    df = pl.concat(
+        (
+            pl.DataFrame(
+                {
+                    "line": [journey["LineRef"]["value"] for journey in journeys],
+                    "operator": [
+                        journey.get("OperatorRef", dict()).get("value") for journey in journeys
+                    ],
+                    "dest_ref": [journey["DestinationRef"]["value"] for journey in journeys],
+                    "dest_name": [journey["DestinationName"][0]["value"] for journey in journeys],
+                    "long_train": [
+                        journey["VehicleFeatureRef"][0] == "longTrain"
+                        if journey.get("VehicleFeatureRef")
+                        else None
+                        for journey in journeys
+                    ],
+                },
+                schema={
+                    "line": pl.String,
+                    "operator": pl.String,
+                    "dest_ref": pl.String,
+                    "dest_name": pl.String,
+                    "long_train": pl.Boolean,
+                },
+            ),
+            read_calls([journey["MonitoredCall"] for journey in journeys]),
+        ),
+        how="horizontal",
+    )
+    if now is not None:
+        df = df.filter(
+            (pl.col("exp_dep_time") < now)
+            | (pl.col("exp_dep_time").is_null() & (pl.col("exp_arr_time") < now))
+        )
+    return df.select(
+        "line",
+        "operator",
+        "arr_status",
+        "dep_status",
+        "aim_arr_time",
+        "aim_dep_time",
+        "exp_arr_time",
+        "exp_dep_time",
+        "order",
+        "dest_ref",
+        "dest_name",
+        "long_train",
+    )
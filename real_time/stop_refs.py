@@ -0,0 +1,79 @@
+import os
+import sys
+
+import polars as pl
+
+from storage import write_parquet_atomic
+from schema import stop_id
+
+# Resolution of the SIRI stop references (`STIF:StopPoint:Q:<id>:`). The stops are identified by the
+# integer id of the quay in the IDFM referential, which is stored by the collectors in the
+# `stop_id` column. Their names and zones are in a small table, built from the referential files
+# `idf/arrets.parquet` and `idf/zones.parquet` and cached in `idf/stop_refs.parquet`.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IDF_DIR = os.path.join(BASE_DIR, "idf")
+ARRETS_FILENAME = os.path.join(IDF_DIR, "arrets.parquet")
+ZONES_FILENAME = os.path.join(IDF_DIR, "zones.parquet")
+STOP_TABLE_FILENAME = os.path.join(IDF_DIR, "stop_refs.parquet")
+
+stop_table_schema = {
+    "stop_id": pl.UInt32,
+    "stop_name": pl.String,
+    "zone_id": pl.UInt32,
+    "zone_name": pl.String,
+}
+
+
+def stop_ref(col="stop_id"):
+    return pl.format("STIF:StopPoint:Q:{}:", pl.col(col)).alias("stop_ref")
+
+
+def build_stop_table():
+    arrets = pl.scan_parquet(ARRETS_FILENAME).select(
+        stop_id=pl.col("arrid").cast(pl.UInt32),
+        stop_name=pl.col("arrname"),
+        zone_id=pl.col("zdaid").cast(pl.UInt32, strict=False),
+    )
+    if os.path.isfile(ZONES_FILENAME):
+        zones = pl.scan_parquet(ZONES_FILENAME).select(
+            zone_id=pl.col("zdaid").cast(pl.UInt32, strict=False), zone_name=pl.col("zdaname")
+        )
+        arrets = arrets.join(zones.unique(subset="zone_id"), on="zone_id", how="left")
+    else:
+        print(f"Warning. Missing file `{ZONES_FILENAME}`, the zone names are unknown")
+        arrets = arrets.with_columns(zone_name=pl.lit(None, dtype=pl.String))
+    return (
+        arrets.unique(subset="stop_id", keep="first", maintain_order=True)
+        .sort("stop_id")
+        .cast(stop_table_schema)
+        .collect()
+    )
+
+
+def is_up_to_date(filename=STOP_TABLE_FILENAME):
+    if not os.path.isfile(filename):
+        return False
+    sources = [f for f in (ARRETS_FILENAME, ZONES_FILENAME) if os.path.isfile(f)]
+    return all(os.path.getmtime(filename) >= os.path.getmtime(f) for f in sources)
+
+
+def read_stop_table(filename=STOP_TABLE_FILENAME):
+    # The table is built again when the referential files change.
+    if is_up_to_date(filename):
+        return pl.read_parquet(filename)
+    df = build_stop_table()
+    write_parquet_atomic(df, filename)
+    return df
+
+
+if __name__ == "__main__":
+    # Usage: python stop_refs.py [STOP_REF ...]
+    # Builds the table (if needed) and prints the given stops, or the size of the table.
+    stops = read_stop_table()
+    if len(sys.argv) > 1:
+        refs = pl.DataFrame({"stop_ref": sys.argv[1:]}).with_columns(stop_id())
+        print(refs.join(stops, on="stop_id", how="left"))
+    else:
+        print(f"{len(stops):,} stops in `{STOP_TABLE_FILENAME}`")
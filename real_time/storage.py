@@ -0,0 +1,128 @@
+import os
+import sys
+import shutil
+from datetime import date, datetime, UTC
+
+import polars as pl
+
+from schema import normalize
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DATA_DIR = os.path.join(BASE_DIR, "data")
+
+# The collectors append the stop times of each poll to a small "shard" file in
+# `data/shards/YYYY-MM-DD/`. The shards of a day are merged into the final daily file
+# `data/YYYY-MM-DD.parquet` by `compact_day`, once the day is over.
+SHARD_DIRNAME = "shards"
+
+# When several records share the same key, the most recent one is kept.
+KEY = ["journey_ref", "stop_id", "stop_ref"]
+
+
+def day_string(now):
+    return f"{now.year}-{now.month:02}-{now.day:02}"
+
+
+def daily_filename(day, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f"{day}.parquet")
+
+
+def shard_dir(day, data_dir=DATA_DIR):
+    return os.path.join(data_dir, SHARD_DIRNAME, day)
+
+
+def list_shards(day, data_dir=DATA_DIR):
+    directory = shard_dir(day, data_dir)
+    if not os.path.isdir(directory):
+        return []
+    # Shard names start with the time of the poll so the sorted list is in chronological order.
+    return [
+        os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith(".parquet")
+    ]
+
+
+def list_days(data_dir=DATA_DIR):
+    days = set()
+    for f in os.listdir(data_dir):
+        if f.endswith(".parquet"):
+            try:
+                days.add(date.fromisoformat(f.removesuffix(".parquet")).isoformat())
+            except ValueError:
+                pass
+    directory = os.path.join(data_dir, SHARD_DIRNAME)
+    if os.path.isdir(directory):
+        days |= set(os.listdir(directory))
+    return sorted(days)
+
+
+def write_parquet_atomic(df, filename):
+    # Readers never see a partially written file.
+    tmp_filename = f"{filename}.tmp"
+    df.write_parquet(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def write_shard(df, now, data_dir=DATA_DIR):
+    directory = shard_dir(day_string(now), data_dir)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, f"{now.strftime('%H%M%S%f')}.parquet")
+    write_parquet_atomic(df, filename)
+    return filename
+
+
+def scan_day(day, data_dir=DATA_DIR, key=KEY, convert=normalize):
+    # Deduplicated view of the stop times of a day, from the daily file and the shards that were
+    # not compacted yet. The files written by older versions are converted to the current types by
+    # `convert`.
+    # The most recent record of each key is kept: the shards are read from the newest and the rows
+    # of a shard are written from the newest poll (see `global_request.py`).
+    frames = [convert(pl.scan_parquet(f)) for f in reversed(list_shards(day, data_dir))]
+    filename = daily_filename(day, data_dir)
+    if os.path.isfile(filename):
+        frames.append(convert(pl.scan_parquet(filename)))
+    if not frames:
+        raise FileNotFoundError(f"No data for day {day}")
+    # The files written by older versions of the collectors may lack some columns.
+    df = frames[0] if len(frames) == 1 else pl.concat(frames, how="diagonal")
+    return df.unique(subset=key, keep="first", maintain_order=True)
+
+
+def compact_day(day, data_dir=DATA_DIR, key=KEY, convert=normalize):
+    shards = list_shards(day, data_dir)
+    if not shards:
+        return
+    df = scan_day(day, data_dir, key, convert).collect()
+    write_parquet_atomic(df, daily_filename(day, data_dir))
+    # The shards are removed only once the daily file is written: until then, the records are read
+    # from the shards (and possibly also from the daily file, in which case they are deduplicated).
+    for f in shards:
+        os.remove(f)
+    if not os.listdir(shard_dir(day, data_dir)):
+        shutil.rmtree(shard_dir(day, data_dir))
+
+
+def compact_previous_days(today, data_dir=DATA_DIR, key=KEY, convert=normalize):
+    directory = os.path.join(data_dir, SHARD_DIRNAME)
+    if not os.path.isdir(directory):
+        return
+    for day in sorted(os.listdir(directory)):
+        if day < today:
+            print(f"Compacting {day}")
+            try:
+                compact_day(day, data_dir, key, convert)
+            except Exception as e:
+                print(f"Warning. Failed to compact day {day}")
+                print(e)
+
+
+if __name__ == "__main__":
+    # Usage: python storage.py [DAY ...]
+    # Compact the given days or, by default, all the days before today.
+    if len(sys.argv) > 1:
+        for day in sys.argv[1:]:
+            compact_day(day)
+    else:
+        # The shards are named after the UTC day.
+        compact_previous_days(day_string(datetime.now(UTC)))
@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import heapq
+from datetime import date
+from collections import defaultdict, deque
+
+import polars as pl
+
+# Inference of the topology of a line (stop graph, branches, endpoints and a reference ordering of
+# the stops for the space-time diagrams) from the recorded stop times.
+# The stop pairs are computed for all the journeys at once with polars. The graph of a line is
+# assumed to be (almost) a tree: the branches and the central edge are derived from a spanning tree
+# in linear time instead of computing the shortest paths between all the pairs of stops.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The topologies are cached as one JSON file per line. A cached topology is reused for the days
+# within `CACHE_DAYS` days of the day it was built from, as long as no new pair of consecutive stops
+# is observed.
+TOPOLOGY_DIR = os.path.join(BASE_DIR, "topologies")
+CACHE_DAYS = 28
+
+
+def scan_positions(df, stop_col):
+    return df.lazy().select(
+        "journey_ref",
+        pl.col(stop_col).alias("stop"),
+        "exp_arr_time",
+        "exp_dep_time",
+        pos=pl.int_range(pl.len()).over("journey_ref"),
+    )
+
+
+def consecutive_stop_pairs(df):
+    # Pairs of consecutive stops, each stop being only considered at its first visit in a journey.
+    first_visits = df.unique(subset=["journey_ref", "stop"], keep="first").sort(
+        "journey_ref", "pos"
+    )
+    return (
+        first_visits.with_columns(
+            next_stop=pl.col("stop").shift(-1).over("journey_ref"),
+            time=(pl.col("exp_arr_time").shift(-1).over("journey_ref") - pl.col("exp_dep_time"))
+            .dt.total_seconds(),
+        )
+        .filter(pl.col("next_stop").is_not_null())
+        .group_by(a="stop", b="next_stop")
+        .agg(pl.col("time").median())
+    )
+
+
+def observed_stop_pairs(df, stop_col="stop"):
+    pairs = consecutive_stop_pairs(scan_positions(df, stop_col)).select("a", "b").collect()
+    return set(pairs.iter_rows())
+
+
+def direct_stop_pairs(df, stop_col="stop"):
+    # `df` has one row per journey and stop, in the order of the journey, with columns
+    # `journey_ref`, `stop_col`, `exp_arr_time` and `exp_dep_time`.
+    # Returns the consecutive stop pairs which are never separated by another stop in a journey,
+    # with the median travel time between them (in seconds).
+    df = scan_positions(df, stop_col)
+    direct = consecutive_stop_pairs(df)
+    # Positions of the stops which are visited only once in a journey.
+    positions = df.filter(pl.len().over("journey_ref", "stop") == 1).select(
+        "journey_ref", "stop", "pos"
+    )
+    # A pair is indirect if, in a journey, there is at least one stop between the two stops.
+    indirect = (
+        direct.select("a", "b")
+        .join(positions.rename({"stop": "a", "pos": "pos_a"}), on="a")
+        .join(positions.rename({"stop": "b", "pos": "pos_b"}), on=["journey_ref", "b"])
+        .filter(pl.col("pos_b") - pl.col("pos_a") >= 2)
+        .select("a", "b")
+        .unique()
+    )
+    return direct.join(indirect, on=["a", "b"], how="anti").sort("a", "b").collect()
+
+
+def build_graph(pairs, extra_edges=()):
+    # Undirected graph (both directions of each pair are added) as a dict node -> {neighbor: time}.
+    graph = defaultdict(dict)
+    for a, b, t in pairs.select("a", "b", "time").iter_rows():
+        graph[a][b] = t
+        graph[b].setdefault(a, t)
+    for a, b, t in extra_edges:
+        graph[a][b] = t
+        graph[b][a] = t
+    return graph
+
+
+def spanning_tree(graph, root):
+    # Parent of each node and nodes in BFS order.
+    parents = {root: None}
+    order = list()
+    queue = deque([root])
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for neighbor in sorted(graph[node]):
+            if neighbor not in parents:
+                parents[neighbor] = node
+                queue.append(neighbor)
+    return parents, order
+
+
+def find_central_edge(graph, root):
+    # On a tree, the betweenness of an edge is the product of the numbers of nodes on each side.
+    parents, order = spanning_tree(graph, root)
+    sizes = defaultdict(lambda: 1)
+    for node in reversed(order[1:]):
+        sizes[parents[node]] += sizes[node]
+    n = len(order)
+    child = max(order[1:], key=lambda node: sizes[node] * (n - sizes[node]))
+    return parents[child], child
+
+
+def side_nodes(graph, start, excluded):
+    # Nodes reachable from `start` without going through `excluded`, with their parent toward
+    # `start`.
+    parents = {start: None, excluded: None}
+    queue = deque([start])
+    while queue:
+        node = queue.popleft()
+        for neighbor in sorted(graph[node]):
+            if neighbor not in parents:
+                parents[neighbor] = node
+                queue.append(neighbor)
+    del parents[excluded]
+    return parents
+
+
+def branch_ordering(parents, root):
+    # Stops of one side of the central edge, from the end of the branches to `root`. The longest
+    # branch is first, then the other branches are placed right before their junction.
+    children = defaultdict(list)
+    for node, parent in parents.items():
+        if parent is not None:
+            children[parent].append(node)
+    heights = dict()
+    order = list()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(children[node])
+    for node in reversed(order):
+        heights[node] = 1 + max((heights[c] for c in children[node]), default=0)
+    sequences = dict()
+    for node in reversed(order):
+        branches = sorted(children[node], key=lambda c: (-heights[c], c))
+        sequences[node] = [n for c in branches for n in sequences.pop(c)] + [node]
+    return sequences[root]
+
+
+def path_to_root(parents, node):
+    path = list()
+    while node is not None:
+        path.append(node)
+        node = parents[node]
+    return path
+
+
+def exclusive_endpoint_nodes(parents, endpoints, other_side):
+    # Nodes that are only on the paths to one endpoint. The nodes of the other side of the central
+    # edge are on the paths to all the endpoints so they are exclusive only if there is one
+    # endpoint.
+    paths = {e: set(path_to_root(parents, e)) for e in endpoints}
+    if len(endpoints) == 1:
+        paths[endpoints[0]] |= set(other_side)
+    counts = defaultdict(int)
+    for nodes in paths.values():
+        for n in nodes:
+            counts[n] += 1
+    return {e: sorted(n for n in nodes if counts[n] == 1) for e, nodes in paths.items()}
+
+
+def travel_times(graph, source):
+    # Dijkstra's algorithm.
+    times = {source: 0.0}
+    heap = [(0.0, source)]
+    while heap:
+        t, node = heapq.heappop(heap)
+        if t > times[node]:
+            continue
+        for neighbor, dt in graph[node].items():
+            if t + dt < times.get(neighbor, float("inf")):
+                times[neighbor] = t + dt
+                heapq.heappush(heap, (t + dt, neighbor))
+    return times
+
+
+def infer_topology(df, stop_col="stop", extra_edges=(), origin=None):
+    # Returns a dict (which can be serialized as JSON) with:
+    # - `edges`: the pairs of adjacent stops, with the median travel time;
+    # - `endpoints`: the stops with only one neighbor;
+    # - `central_edge`: the edge (s, t) with the highest betweenness, the forward direction is
+    #   from s to t (if given, `origin` is on the side of s);
+    # - `fwd_path`: all the stops in the forward order;
+    # - `time_dict`: travel time from s to each stop (negative for the stops before s);
+    # - `fwd_endpoints_nodes` / `bwd_endpoints_nodes`: the stops that are only served by the
+    #   journeys going to each endpoint.
+    pairs = direct_stop_pairs(df, stop_col)
+    graph = build_graph(pairs, extra_edges)
+    if not graph:
+        raise Exception("Cannot infer the topology of a line without stop pairs")
+    nodes = sorted(graph)
+    if origin is None or origin not in graph:
+        origin = nodes[0]
+    s, t = find_central_edge(graph, origin)
+    s_parents = side_nodes(graph, s, t)
+    t_parents = side_nodes(graph, t, s)
+    if origin in t_parents:
+        s, t = t, s
+        s_parents, t_parents = t_parents, s_parents
+    endpoints = [n for n in nodes if len(graph[n]) == 1 and (n in s_parents or n in t_parents)]
+    fwd_endpoints = [e for e in endpoints if e in t_parents]
+    bwd_endpoints = [e for e in endpoints if e in s_parents]
+    fwd_path = branch_ordering(s_parents, s) + branch_ordering(t_parents, t)[::-1]
+    times = travel_times(graph, s)
+    time_dict = {n: -times[n] if n in s_parents else times[n] for n in fwd_path if n in times}
+    return {
+        "edges": [[a, b, graph[a][b]] for a in nodes for b in sorted(graph[a])],
+        "endpoints": endpoints,
+        "central_edge": [s, t],
+        "fwd_path": fwd_path,
+        "time_dict": time_dict,
+        "fwd_endpoints_nodes": exclusive_endpoint_nodes(t_parents, fwd_endpoints, s_parents),
+        "bwd_endpoints_nodes": exclusive_endpoint_nodes(s_parents, bwd_endpoints, t_parents),
+    }
+
+
+def find_endpoint(topology, last_stop, is_fwd):
+    # Endpoint of a journey from the last stop it was seen at.
+    key = "fwd_endpoints_nodes" if is_fwd else "bwd_endpoints_nodes"
+    for endpoint, nodes in topology[key].items():
+        if last_stop in nodes:
+            return endpoint
+    return "Unknown fwd" if is_fwd else "Unknown bwd"
+
+
+def shortest_path(topology, source, target):
+    # Path with the fewest stops between two stops.
+    graph = defaultdict(list)
+    for a, b, _ in topology["edges"]:
+        graph[a].append(b)
+    parents = {source: None}
+    queue = deque([source])
+    while queue:
+        node = queue.popleft()
+        if node == target:
+            return path_to_root(parents, target)[::-1]
+        for neighbor in graph[node]:
+            if neighbor not in parents:
+                parents[neighbor] = node
+                queue.append(neighbor)
+    raise Exception(f"No path from `{source}` to `{target}`")
+
+
+def topology_filename(line, topology_dir=TOPOLOGY_DIR):
+    return os.path.join(topology_dir, re.sub(r"[^A-Za-z0-9]+", "_", line).strip("_") + ".json")
+
+
+def read_cached_topology(line, topology_dir=TOPOLOGY_DIR):
+    filename = topology_filename(line, topology_dir)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except ValueError:
+        print(f"Warning. Invalid topology cache file `{filename}`")
+        return None
+
+
+def cached_topology(
+    line, day, df, stop_col="stop", extra_edges=(), origin=None, topology_dir=TOPOLOGY_DIR
+):
+    # Same as `infer_topology` but the topology of the line is read from the cache if it is still
+    # valid for `day` (YYYY-MM-DD), otherwise it is inferred and the cache is updated.
+    day = date.fromisoformat(str(day))
+    parameters = json.loads(json.dumps({"extra_edges": list(extra_edges), "origin": origin}))
+    pairs = observed_stop_pairs(df, stop_col)
+    cache = read_cached_topology(line, topology_dir)
+    if (
+        cache is not None
+        and cache["parameters"] == parameters
+        and abs((day - date.fromisoformat(cache["built_on"])).days) <= CACHE_DAYS
+        and pairs <= set(map(tuple, cache["observed_pairs"]))
+    ):
+        return cache["topology"]
+    topology = infer_topology(df, stop_col, extra_edges, origin)
+    if not os.path.isdir(topology_dir):
+        os.makedirs(topology_dir)
+    filename = topology_filename(line, topology_dir)
+    with open(f"{filename}.tmp", "w") as f:
+        json.dump(
+            {
+                "line": line,
+                "built_on": day.isoformat(),
+                "parameters": parameters,
+                "observed_pairs": sorted(pairs),
+                "topology": topology,
+            },
+            f,
+        )
+    os.replace(f"{filename}.tmp", filename)
+    return topology
@@ -1,25 +1,23 @@
 import os
-from datetime import datetime
-import json
+import argparse
+from datetime import datetime, UTC
+from concurrent.futures import ThreadPoolExecutor
 
-import pytz
 import requests
 import polars as pl
 
-API_URL = "https://prim.iledefrance-mobilites.fr/marketplace"
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-
-secrets_file = os.path.join(BASE_DIR, "..", "secrets.json")
-if os.path.isfile(secrets_file):
-    with open(secrets_file, "r") as f:
-        secrets = json.load(f)
-        API_KEY = secrets["api_key"]
-else:
-    raise Exception(f"Cannot read API Key from `{secrets_file}`")
+from prim import API_URL, BASE_DIR, new_session
+from raw import LINE_REPORTS, RawCapture
+from line_reports import tz, params, schema, read_disruptions
+from scheduler import NORMAL
 
 OUTPUT_DIR = os.path.join(BASE_DIR, "data")
-if not os.path.isdir(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
+
+# The line reports are requested concurrently, with at most `MAX_WORKERS` requests in flight.
+MAX_WORKERS = 16
+# Timeout (in seconds) and number of retries of each request.
+TIMEOUT = 30
+RETRIES = 3
 
 lines = [
     "C01372",
@@ -83,138 +81,71 @@ lines = [
 ]
 
 
-def is_valid_disruption(disruption: dict):
-    return (
-        (disruption["status"] == "active")
-        and ("Ascenseur" not in disruption.get("tags", []))
-        and (disruption.get("category") != "Communication")
-    )
-
-
-def get_from_to_stops(impacted_object: dict):
-    inner = None
-    if "impacted_rail_section" in impacted_object:
-        inner = impacted_object["impacted_rail_section"]
-    if "impacted_section" in impacted_object:
-        inner = impacted_object["impacted_section"]
-    if inner is None:
-        return
-    if "from" not in inner or "to" not in inner:
+def fetch_line_report(session, line):
+    try:
+        response = session.get(
+            f"{API_URL}/v2/navitia/line_reports/lines/line:IDFM:{line}/line_reports",
+            params=params,
+            timeout=TIMEOUT,
+        )
+    except requests.RequestException as e:
+        print(f"Warning. Request failed for line {line}")
+        print(e)
         return None
-    from_stop = inner["from"]
-    to_stop = inner["to"]
-    return {
-        "from": {
-            "id": from_stop["id"],
-            "name": from_stop["name"],
-        },
-        "to": {
-            "id": to_stop["id"],
-            "name": to_stop["name"],
-        },
-    }
-
-
-def is_valid_period(period: dict, now: datetime):
-    begin = datetime.fromisoformat(period["begin"]).astimezone(tz)
-    end = datetime.fromisoformat(period["end"]).astimezone(tz)
-    return begin <= now and end >= now
-
-tz = pytz.timezone("Europe/Paris")
-
-now = datetime.now(tz)
-now_str = now.strftime("%Y%m%dT%H%M%S")
-params = {
-    "disable_geojson": True,
-    #  "until": now_str,
-}
-
-disruptions = list()
-
-
-for line in lines:
-    print(line)
-    response = requests.get(
-        f"{API_URL}/v2/navitia/line_reports/lines/line:IDFM:{line}/line_reports",
-        headers={"apiKey": API_KEY},
-        params=params,
+    if not response.ok:
+        print(f"Warning. Error retrieving line reports of line {line}")
+        print(f"Code: {response.status_code}")
+        print(f"Reason: {response.reason}")
+        return None
+    return response.json()
+
+
+def fetch_disruptions(lines, now, max_workers=MAX_WORKERS, capture=False):
+    # If `capture` is true, the raw responses are archived (see `raw.py`).
+    session = new_session(pool_size=max_workers, retries=RETRIES, priority=NORMAL)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda line: fetch_line_report(session, line), lines)
+        responses = {line: data for line, data in zip(lines, results) if data is not None}
+    if capture:
+        with RawCapture(LINE_REPORTS, now.astimezone(UTC)) as raw:
+            raw.write_json(responses)
+    disruptions = [
+        x for line, data in responses.items() for x in read_disruptions(data, line, now)
+    ]
+    return pl.DataFrame(disruptions, schema=schema)
+
+
+def save_disruptions(df, now):
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    output_filename = os.path.join(
+        OUTPUT_DIR, f"traffic-{now.year}-{now.month:02}-{now.day:02}.parquet"
     )
-    if response.ok:
-        data = response.json()
-        for disruption in filter(is_valid_disruption, data["disruptions"]):
-            title = next(
-                map(
-                    lambda m: m["text"],
-                    filter(lambda m: m["channel"]["name"] == "titre", disruption["messages"]),
-                )
-            )
-            message = next(
-                map(
-                    lambda m: m["text"],
-                    filter(lambda m: m["channel"]["name"] == "moteur", disruption["messages"]),
-                )
-            )
-            impacted_objects = filter(
-                lambda o: o["pt_object"]["id"] == f"line:IDFM:{line}",
-                disruption["impacted_objects"],
-            )
-            from_to_stops = list(
-                filter(lambda x: x is not None, map(get_from_to_stops, impacted_objects))
-            )
-            try:
-                period = next(
-                    filter(lambda p: is_valid_period(p, now), disruption["application_periods"])
-                )
-            except StopIteration:
-                begin = None
-            else:
-                begin = datetime.fromisoformat(period["begin"]).astimezone(tz)
-            x = {
-                "id": disruption["disruption_id"],
-                "line": line,
-                "start": begin,
-                "end": now,
-                "cause": disruption["cause"],
-                "category": disruption["category"],
-                "severity": disruption["severity"],
-                "tags": disruption.get("tags", []),
-                "title": title,
-                "message": message,
-                "from_to": from_to_stops,
-            }
-            disruptions.append(x)
-
-
-stop_struct = pl.Struct({"id": pl.String, "name": pl.String})
-schema = {
-    "id": pl.String,
-    "line": pl.String,
-    "start": pl.Datetime,
-    "end": pl.Datetime,
-    "cause": pl.String,
-    "category": pl.String,
-    "severity": pl.Struct(
-        {"name": pl.String, "effect": pl.String, "color": pl.String, "priority": pl.Int64}
-    ),
-    "tags": pl.List(pl.String),
-    "title": pl.String,
-    "message": pl.String,
-    "from_to": pl.List(pl.Struct({"from": stop_struct, "to": stop_struct})),
-}
-df = pl.DataFrame(disruptions, schema=schema)
-
-output_filename = os.path.join(
-    OUTPUT_DIR, f"traffic-{now.year}-{now.month:02}-{now.day:02}.parquet"
-)
-
-if os.path.isfile(output_filename):
-    old_df = pl.scan_parquet(output_filename)
-
-    df = (
-        pl.concat((old_df, df.lazy()), how="vertical", rechunk=True)
-        .unique(subset=["id"], keep="last", maintain_order=True)
-        .collect()
+    if os.path.isfile(output_filename):
+        old_df = pl.scan_parquet(output_filename)
+
+        df = (
+            pl.concat((old_df, df.lazy()), how="vertical", rechunk=True)
+            .unique(subset=["id"], keep="last", maintain_order=True)
+            .collect()
+        )
+
+    print(len(df))
+    df.write_parquet(output_filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="maximum number of concurrent requests",
     )
-
-print(len(df))
-df.write_parquet(output_filename)
+    parser.add_argument(
+        "--capture", action="store_true", help="archive the raw responses in `data/raw/`"
+    )
+    args = parser.parse_args()
+    now = datetime.now(tz)
+    df = fetch_disruptions(lines, now, args.max_workers, args.capture)
+    save_disruptions(df, now)
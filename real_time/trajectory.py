@@ -0,0 +1,130 @@
+import argparse
+from datetime import datetime, time
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import polars as pl
+
+from plot import EXTRA_EDGES, ORIGINS, load_day
+from render import journey_points
+from topology import cached_topology
+
+# Positions of the vehicles of a line between the stops, at any time.
+# The trajectory of a journey is the piecewise-linear function of time through its points of the
+# space-time diagram (arrival then departure at each stop, see `render.journey_points`), the
+# position being the coordinate of the stops on the line (`time_dict` of the topology).
+# The points of all the journeys are stored in flat arrays, sorted by journey then time. The times
+# of the journey i are shifted by i * span (span being longer than all the trajectories), so that
+# they are sorted as a whole and the segments of any batch of (journey, time) queries are found
+# with a single `np.searchsorted`.
+
+TIMEZONE = "Europe/Paris"
+
+
+def build_trajectories(df, topology, stop_col="stop"):
+    points = journey_points(df, topology, stop_col)
+    journeys = points.group_by("journey_ref", maintain_order=True).agg(
+        pl.col("is_fwd", "is_bwd", "endpoint").first(), n_points=pl.len()
+    )
+    times = points["time"].dt.epoch("us").to_numpy()
+    n_points = journeys["n_points"].cast(pl.Int64).to_numpy()
+    offsets = np.concatenate(([0], np.cumsum(n_points)))
+    origin = times.min() if len(times) else 0
+    span = times.max() - origin + 1 if len(times) else 1
+    return {
+        "journeys": journeys.drop("n_points"),
+        "offsets": offsets,
+        "origin": origin,
+        "span": span,
+        "keys": times - origin + np.repeat(np.arange(len(journeys)) * span, n_points),
+        "positions": points["y"].to_numpy(),
+        "stops": points["stop"].to_numpy(),
+        "first_times": times[offsets[:-1]],
+        "last_times": times[offsets[1:] - 1],
+        "time_zone": points["time"].dtype.time_zone,
+    }
+
+
+def evaluate(trajectories, journey_idx, times):
+    # Positions of the journeys `journey_idx` at `times` (microseconds since the epoch), with the
+    # indices of the points at the start and at the end of their segments. The position is NaN if
+    # the journey is not running at that time.
+    keys = trajectories["keys"]
+    positions = trajectories["positions"]
+    start = trajectories["offsets"][journey_idx]
+    end = trajectories["offsets"][journey_idx + 1] - 1
+    query = times - trajectories["origin"] + journey_idx * trajectories["span"]
+    i = np.searchsorted(keys, query, side="right") - 1
+    is_running = (i >= start) & (query <= keys[end])
+    left = np.clip(i, start, end)
+    right = np.minimum(left + 1, end)
+    dt = keys[right] - keys[left]
+    ratio = np.divide(query - keys[left], dt, out=np.zeros(len(dt)), where=dt > 0)
+    values = positions[left] + ratio * (positions[right] - positions[left])
+    return np.where(is_running, values, np.nan), left, right
+
+
+def running_journeys(trajectories, times):
+    # All the pairs (journey, time) where the journey is running, `times` being sorted. Each journey
+    # is only paired with the range of times between its first and last points.
+    first = np.searchsorted(times, trajectories["first_times"], side="left")
+    last = np.searchsorted(times, trajectories["last_times"], side="right")
+    counts = np.maximum(last - first, 0)
+    journey_idx = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    time_idx = np.arange(counts.sum()) - np.repeat(starts - first, counts)
+    return journey_idx, time_idx
+
+
+def positions_at(trajectories, times):
+    # Position of all the running journeys at each of `times` (timezone-aware datetimes), with the
+    # stops before and after them.
+    times = pl.Series("time", times).dt.convert_time_zone(trajectories["time_zone"]).unique().sort()
+    journey_idx, time_idx = running_journeys(trajectories, times.dt.epoch("us").to_numpy())
+    values, left, right = evaluate(
+        trajectories, journey_idx, times.dt.epoch("us").to_numpy()[time_idx]
+    )
+    return pl.concat(
+        (
+            times.gather(time_idx).to_frame(),
+            trajectories["journeys"][journey_idx],
+            pl.DataFrame(
+                {
+                    "position": values,
+                    "from_stop": trajectories["stops"][left],
+                    "to_stop": trajectories["stops"][right],
+                },
+                schema={"position": pl.Float64, "from_stop": pl.String, "to_stop": pl.String},
+            ),
+        ),
+        how="horizontal",
+    ).sort("time", "position")
+
+
+def frames(trajectories, start, end, interval="10s"):
+    # Positions of the journeys at regular times, e.g. for an animation (one frame per time).
+    times = pl.datetime_range(start, end, interval, eager=True, time_unit="us")
+    return positions_at(trajectories, times)
+
+
+def load_trajectories(day, line):
+    df = load_day(day, [line])
+    topology = cached_topology(
+        line, day, df, "stop", EXTRA_EDGES.get(line, ()), origin=ORIGINS.get(line)
+    )
+    return build_trajectories(df, topology)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("day", help="YYYY-MM-DD")
+    parser.add_argument("line", help="e.g. STIF:Line::C01742:")
+    parser.add_argument("times", nargs="+", help="local times (HH:MM)")
+    args = parser.parse_args()
+    trajectories = load_trajectories(args.day, args.line)
+    day = datetime.fromisoformat(args.day).date()
+    times = [
+        datetime.combine(day, time.fromisoformat(t), tzinfo=ZoneInfo(TIMEZONE)) for t in args.times
+    ]
+    with pl.Config(tbl_rows=-1):
+        print(positions_at(trajectories, times))
@@ -1,110 +1,127 @@
-import os
+import argparse
 from datetime import datetime, UTC
-import json
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import polars as pl
 
-API_URL = "https://prim.iledefrance-mobilites.fr/marketplace"
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-
-secrets_file = os.path.join(BASE_DIR, "..", "secrets.json")
-if os.path.isfile(secrets_file):
-    with open(secrets_file, "r") as f:
-        secrets = json.load(f)
-        API_KEY = secrets["api_key"]
-else:
-    raise Exception(f"Cannot read API Key from `{secrets_file}`")
+from prim import API_URL, new_session
+from scheduler import LOW
+from siri import flatten_monitored_visits
+from schema import stop_id
 
 BOISSYS = ("STIF:StopPoint:Q:412802:", "STIF:StopPoint:Q:473984:", "STIF:StopPoint:Q:473988:", "STIF:StopPoint:Q:473987:")
 
 RER_A = "STIF:Line::C01742:"
 
-df = (
-    pl.scan_parquet(
-        "./perimetre-des-donnees-tr-disponibles-plateforme-idfm.parquet"
+PERIMETER_FILENAME = "./perimetre-des-donnees-tr-disponibles-plateforme-idfm.parquet"
+
+# The stops are requested concurrently, with at most `MAX_WORKERS` requests in flight.
+MAX_WORKERS = 16
+TIMEOUT = 30
+RETRIES = 2
+
+COLUMNS = [
+    "line",
+    "stop_ref",
+    "stop_id",
+    "stop_name",
+    "operator",
+    "arr_status",
+    "dep_status",
+    "aim_arr_time",
+    "aim_dep_time",
+    "exp_arr_time",
+    "exp_dep_time",
+    "order",
+    "dest_ref",
+    "dest_name",
+    "long_train",
+]
+
+
+def read_line_stops(lines):
+    return (
+        pl.scan_parquet(PERIMETER_FILENAME)
+        .filter(pl.col("line").is_in(lines))
+        .select("line", "ns2_stoppointref", "ns2_stopname")
+        .collect()
     )
-    .filter(pl.col("line") == RER_A)
-    .select("ns2_stoppointref", "ns2_stopname")
-    .collect()
-)
 
-stop_times = list()
 
-for stop_ref, stop_name in zip(df["ns2_stoppointref"], df["ns2_stopname"]):
-    print(f"=== {stop_name} ===")
-    now = datetime.now(UTC)
+def fetch_stop_visits(session, line, stop_ref, stop_name, now):
     params = {
         "MonitoringRef": stop_ref,
-        "LineRef": RER_A,
+        "LineRef": line,
     }
-    response = requests.get(
-        f"{API_URL}/stop-monitoring",
-        headers={"apiKey": API_KEY},
-        params=params,
-    )
-    if response.ok:
-        timetable = (
+    try:
+        response = session.get(f"{API_URL}/stop-monitoring", params=params, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Warning. Request failed for stop {stop_name}")
+        print(e)
+        return None
+    if not response.ok:
+        print(f"Warning. Error retrieving stop {stop_name}")
+        print(f"Code: {response.status_code}")
+        print(f"Reason: {response.reason}")
+        return None
+    try:
+        deliveries = (
             response.json()
             .get("Siri", dict())
             .get("ServiceDelivery", dict())
-            .get("StopMonitoringDelivery", list())[0]
-            .get("MonitoredStopVisit")
+            .get("StopMonitoringDelivery", list())
         )
-        if timetable is None:
-            print("Invalid response")
-        for record in timetable:
-            if not "MonitoredCall" in record.get("MonitoredVehicleJourney", dict()):
-                print(record)
-                continue
-            data = record["MonitoredVehicleJourney"]
-            exp_dep_time = data["MonitoredCall"].get("ExpectedDepartureTime")
-            exp_arr_time = data["MonitoredCall"].get("ExpectedArrivalTime")
-            past_dep_time = (
-                bool(exp_dep_time)
-                and datetime.fromisoformat(exp_dep_time) < now
-            )
-            past_arr_time = (
-                bool(exp_arr_time)
-                and datetime.fromisoformat(exp_arr_time) < now
-            )
-            if past_dep_time or (past_arr_time and exp_dep_time is None):
-                aim_dep_time = data["MonitoredCall"].get("AimedDepartureTime")
-                aim_arr_time = data["MonitoredCall"].get("AimedArrivalTime")
-                dep_status = data["MonitoredCall"].get("DepartureStatus")
-                arr_status = data["MonitoredCall"].get("ArrivalStatus")
-                order = data["MonitoredCall"].get("Order")
-                dest_ref = data["DestinationRef"]["value"]
-                dest_name = data["DestinationName"][0]["value"]
-                line = data["LineRef"]["value"]
-                operator = data["OperatorRef"]["value"]
-                long_train = data["VehicleFeatureRef"][0] == "longTrain"
-                stop_times.append({
-                    "line": line,
-                    "stop_ref": stop_ref,
-                    "stop_name": stop_name,
-                    "operator": operator,
-                    "arr_status": arr_status,
-                    "dep_status": dep_status,
-                    "aim_arr_time": aim_arr_time,
-                    "aim_dep_time": aim_dep_time,
-                    "exp_arr_time": exp_arr_time,
-                    "exp_dep_time": exp_dep_time,
-                    "order": order,
-                    "dest_ref": dest_ref,
-                    "dest_name": dest_name,
-                    "long_train": long_train,
-                })
-    else:
-        print(f"Code: {response.code}")
-        print(f"Reason: {response.reason}")
+    except ValueError:
+        deliveries = list()
+    timetable = deliveries[0].get("MonitoredStopVisit") if deliveries else None
+    if timetable is None:
+        print(f"Warning. Invalid response for stop {stop_name}")
+        return None
+    try:
+        visits = flatten_monitored_visits(timetable, now)
+    except Exception as e:
+        # E.g. a visit without an expected field: only this stop is skipped.
+        print(f"Warning. Invalid visits for stop {stop_name}")
+        print(e)
+        return None
+    return (
+        visits.with_columns(stop_ref=pl.lit(stop_ref), stop_name=pl.lit(stop_name))
+        .with_columns(stop_id())
+    )
+
+
+def sweep(lines, max_workers=MAX_WORKERS):
+    # All the stops are requested at the same time and the visits are filtered with the same `now`,
+    # so that the result is a snapshot of the lines.
+    stops = read_line_stops(lines)
+    session = new_session(pool_size=max_workers, retries=RETRIES, priority=LOW)
+    now = datetime.now(UTC)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda row: fetch_stop_visits(session, *row, now),
+            stops.iter_rows(),
+        )
+        stop_times = [df for df in results if df is not None]
+    print(f"{len(stop_times)} / {len(stops)} stops retrieved")
+    if not stop_times:
+        return None
+    return pl.concat(stop_times, how="vertical").select(COLUMNS)
+
 
-stop_times_df = (
-    pl.DataFrame(stop_times)
-    .with_columns(
-        pl.col("aim_arr_time").str.to_datetime(),
-        pl.col("aim_dep_time").str.to_datetime(),
-        pl.col("exp_arr_time").str.to_datetime(),
-        pl.col("exp_dep_time").str.to_datetime(),
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lines", nargs="*", default=[RER_A], help="line refs (default: RER A)")
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="maximum number of concurrent requests",
     )
-)
+    parser.add_argument("--output", help="parquet file where the stop times are written")
+    args = parser.parse_args()
+    stop_times_df = sweep(args.lines, args.max_workers)
+    if stop_times_df is not None:
+        print(stop_times_df)
+        if args.output:
+            stop_times_df.write_parquet(args.output)
@@ -3,6 +3,8 @@ import os
 import polars as pl
 import geopandas as gpd
 
+from views import scan_route_stops
+
 #  OUTPUT_DIR = "./data/reseau-urbain-et-interurbain-dile-de-france-mobilites"
 #  OUTPUT_STOPS = "idf_stops.parquet"
 #  OUTPUT_LINES = "idf_lines.parquet"
@@ -23,14 +25,7 @@ routes = (
     .collect()
 )
 
-route_stop_map = (
-    pl.scan_parquet(os.path.join(OUTPUT_DIR, "trips.parquet"))
-    .join(pl.scan_parquet(os.path.join(OUTPUT_DIR, "sequences.parquet")), on="sequence_id")
-    .group_by("route_id")
-    .agg(pl.col("stop_id").explode().unique())
-    .explode("stop_id")
-    .collect()
-)
+route_stop_map = scan_route_stops(OUTPUT_DIR).collect()
 
 bus_stops = (
     routes.lazy()
@@ -0,0 +1,167 @@
+import os
+import sys
+from datetime import date
+
+import polars as pl
+import pyarrow as pa
+
+# Approximate number of stop times in each batch returned by `iter_stop_times`.
+BATCH_SIZE = 1_000_000
+
+
+def scan_patterns(slug_dir):
+    # One row per stop of each timing, with arrival and departure times relative to the start time
+    # of the trip.
+    timings = pl.scan_parquet(os.path.join(slug_dir, "timings.parquet"))
+    sequences = pl.scan_parquet(os.path.join(slug_dir, "sequences.parquet")).select(
+        "sequence_id", "stop_id"
+    )
+    return (
+        timings.join(sequences, on="sequence_id")
+        .select("timing_id", "stop_id", "stopping_time", "between_stop_time")
+        .explode("stop_id", "stopping_time", "between_stop_time")
+        .with_columns(
+            stop_sequence=pl.int_range(pl.len(), dtype=pl.UInt16).over("timing_id"),
+            arrival_offset=(pl.col("stopping_time") + pl.col("between_stop_time"))
+            .cum_sum()
+            .shift(1, fill_value=0)
+            .over("timing_id"),
+        )
+        .with_columns(departure_offset=pl.col("arrival_offset") + pl.col("stopping_time"))
+        .select("timing_id", "stop_sequence", "stop_id", "arrival_offset", "departure_offset")
+    )
+
+
+def scan_trip_dates(slug_dir, start_date=None, end_date=None):
+    trip_dates = pl.scan_parquet(os.path.join(slug_dir, "trip_dates.parquet"))
+    if start_date is not None:
+        trip_dates = trip_dates.filter(pl.col("date") >= start_date)
+    if end_date is not None:
+        trip_dates = trip_dates.filter(pl.col("date") <= end_date)
+    return trip_dates.explode("trip_id").drop_nulls("trip_id")
+
+
+def scan_stop_times(slug_dir, start_date=None, end_date=None):
+    # Arrival and departure times are in seconds since midnight of `date`, like in the GTFS
+    # stop_times.txt file.
+    trips = pl.scan_parquet(os.path.join(slug_dir, "trips.parquet")).select(
+        "trip_id", "route_id", "start_time", "timing_id"
+    )
+    return (
+        scan_trip_dates(slug_dir, start_date, end_date)
+        .join(trips, on="trip_id")
+        .join(scan_patterns(slug_dir), on="timing_id")
+        .select(
+            "date",
+            "trip_id",
+            "route_id",
+            "stop_sequence",
+            "stop_id",
+            arrival_time=pl.col("start_time") + pl.col("arrival_offset"),
+            departure_time=pl.col("start_time") + pl.col("departure_offset"),
+        )
+    )
+
+
+def trip_stop_times(day_trips, patterns):
+    return (
+        day_trips.join(patterns, on="timing_id")
+        .select(
+            "trip_id",
+            "date",
+            "stop_sequence",
+            "stop_id",
+            arrival_time=pl.col("start_time") + pl.col("arrival_offset"),
+            departure_time=pl.col("start_time") + pl.col("departure_offset"),
+        )
+        .sort("trip_id", "stop_sequence")
+    )
+
+
+def iter_stop_times(slug_dir, start_date=None, end_date=None, batch_size=BATCH_SIZE):
+    # Same as `scan_stop_times` but the stop times are returned as batches (sorted by date, trip and
+    # stop sequence) so that the whole date range is never loaded in memory.
+    # A single empty batch is returned if there is no stop time in the date range, so that the
+    # output files still have a schema.
+    patterns = scan_patterns(slug_dir).sort("timing_id", "stop_sequence").collect()
+    trips = (
+        pl.scan_parquet(os.path.join(slug_dir, "trips.parquet"))
+        .select("trip_id", "start_time", "timing_id")
+        .join(patterns.lazy().group_by("timing_id").agg(n_stops=pl.len()), on="timing_id")
+        .collect()
+    )
+    trip_dates = pl.scan_parquet(os.path.join(slug_dir, "trip_dates.parquet"))
+    dates = (
+        scan_trip_dates(slug_dir, start_date, end_date)
+        .select(pl.col("date").unique().sort())
+        .collect()["date"]
+    )
+    is_empty = True
+    for d in dates:
+        day_trips = (
+            trip_dates.filter(pl.col("date") == d)
+            .explode("trip_id")
+            .join(trips.lazy(), on="trip_id")
+            .sort("trip_id")
+            .with_columns(batch=(pl.col("n_stops").cum_sum() - 1) // batch_size)
+            .collect()
+        )
+        for (_,), batch in day_trips.group_by("batch", maintain_order=True):
+            is_empty = False
+            yield trip_stop_times(batch, patterns)
+    if is_empty:
+        no_trips = trip_dates.clear().explode("trip_id").join(trips.lazy(), on="trip_id")
+        yield trip_stop_times(no_trips.collect(), patterns)
+
+
+def seconds_to_gtfs_time(col_name):
+    # Inverse of `time_col_to_seconds` in `gtfs_to_parquet.py` (hours can be larger than 24).
+    return pl.format(
+        "{}:{}:{}",
+        (pl.col(col_name) // 3600).cast(pl.String).str.zfill(2),
+        (pl.col(col_name) // 60 % 60).cast(pl.String).str.zfill(2),
+        (pl.col(col_name) % 60).cast(pl.String).str.zfill(2),
+    ).alias(col_name)
+
+
+def write_gtfs_stop_times(slug_dir, output_filename, start_date=None, end_date=None):
+    # The trips of the stored timetables are not specific to a date so the date is appended to the
+    # trip ids of the output file.
+    stop_ids = (
+        pl.scan_parquet(os.path.join(slug_dir, "stops.parquet"))
+        .select("stop_id", "original_stop_id")
+        .collect()
+    )
+    with open(output_filename, "w") as f:
+        for i, batch in enumerate(iter_stop_times(slug_dir, start_date, end_date)):
+            batch.join(stop_ids, on="stop_id", how="left").select(
+                trip_id=pl.format("{}_{}", "trip_id", pl.col("date").dt.strftime("%Y%m%d")),
+                arrival_time=seconds_to_gtfs_time("arrival_time"),
+                departure_time=seconds_to_gtfs_time("departure_time"),
+                stop_id="original_stop_id",
+                stop_sequence="stop_sequence",
+            ).write_csv(f, include_header=i == 0)
+
+
+def write_arrow_stop_times(slug_dir, output_filename, start_date=None, end_date=None):
+    writer = None
+    with pa.OSFile(output_filename, "wb") as sink:
+        for batch in iter_stop_times(slug_dir, start_date, end_date):
+            table = batch.to_arrow()
+            if writer is None:
+                writer = pa.ipc.new_file(sink, table.schema)
+            writer.write_table(table)
+        writer.close()
+
+
+if __name__ == "__main__":
+    # Usage: python stop_times.py SLUG_DIR OUTPUT_FILENAME [START_DATE [END_DATE]]
+    # The output is written as a GTFS stop_times file, or as an Arrow IPC file if the filename ends
+    # with `.arrow`.
+    slug_dir, output_filename = sys.argv[1:3]
+    start_date = date.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 else None
+    end_date = date.fromisoformat(sys.argv[4]) if len(sys.argv) > 4 else None
+    if output_filename.endswith(".arrow"):
+        write_arrow_stop_times(slug_dir, output_filename, start_date, end_date)
+    else:
+        write_gtfs_stop_times(slug_dir, output_filename, start_date, end_date)
@@ -0,0 +1,73 @@
+import os
+
+import polars as pl
+
+# Small tables derived from the trips, sequences and routes, maintained by `gtfs_to_parquet.py` so
+# that the network and stop exports do not need to explode the stop sequences of all the trips.
+ROUTE_STOPS_FILENAME = "route_stops.parquet"
+STOP_MODES_FILENAME = "stop_modes.parquet"
+
+
+def compute_route_stops(trips, sequences):
+    return (
+        trips.select("route_id", "sequence_id")
+        .unique()
+        .join(sequences.select("sequence_id", "stop_id"), on="sequence_id")
+        .explode("stop_id")
+        .select("route_id", "stop_id")
+        .unique()
+    )
+
+
+def compute_stop_modes(route_stops, routes):
+    return (
+        route_stops.join(
+            routes.select("route_id", mode=pl.col("route_type").cast(pl.String)), on="route_id"
+        )
+        .select("stop_id", "mode")
+        .unique()
+        .group_by("stop_id")
+        .agg(modes="mode")
+        .sort("stop_id")
+    )
+
+
+def update_views(output_dir, trips, sequences, routes, n_previous_trips=0):
+    # Only the trips added since the previous update (i.e., with index larger than
+    # `n_previous_trips`) are read, unless the views have never been built.
+    filename = os.path.join(output_dir, ROUTE_STOPS_FILENAME)
+    if os.path.isfile(filename):
+        route_stops = compute_route_stops(trips.lazy().slice(n_previous_trips), sequences.lazy())
+        route_stops = pl.concat(
+            (pl.scan_parquet(filename), route_stops), how="vertical", rechunk=True
+        ).unique(keep="first", maintain_order=True)
+    else:
+        route_stops = compute_route_stops(trips.lazy(), sequences.lazy())
+    route_stops = route_stops.collect()
+    stop_modes = compute_stop_modes(route_stops.lazy(), routes.lazy()).collect()
+    route_stops.write_parquet(filename)
+    stop_modes.write_parquet(os.path.join(output_dir, STOP_MODES_FILENAME))
+
+
+def build_views(output_dir):
+    trips = pl.scan_parquet(os.path.join(output_dir, "trips.parquet"))
+    sequences = pl.scan_parquet(os.path.join(output_dir, "sequences.parquet"))
+    routes = pl.scan_parquet(os.path.join(output_dir, "routes.parquet"))
+    filename = os.path.join(output_dir, ROUTE_STOPS_FILENAME)
+    if os.path.isfile(filename):
+        os.remove(filename)
+    update_views(output_dir, trips, sequences, routes)
+
+
+def scan_route_stops(output_dir):
+    filename = os.path.join(output_dir, ROUTE_STOPS_FILENAME)
+    if not os.path.isfile(filename):
+        build_views(output_dir)
+    return pl.scan_parquet(filename)
+
+
+def scan_stop_modes(output_dir):
+    filename = os.path.join(output_dir, STOP_MODES_FILENAME)
+    if not os.path.isfile(filename):
+        build_views(output_dir)
+    return pl.scan_parquet(filename)